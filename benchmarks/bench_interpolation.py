@@ -0,0 +1,70 @@
+"""
+Compares the precompiled {{...}} interpolation against the original
+re.sub/eval engine on large synthetic templates.
+
+    python benchmarks/bench_interpolation.py --lines 20000 --renders 20
+"""
+import re
+from argparse import ArgumentParser
+from time import perf_counter
+
+from proyo.template import translate, template_globals
+
+
+def make_template(lines, density, block):
+    out = []
+    for i in range(lines):
+        if i % block == 0:
+            out.append('# ~ if enabled:' if i % (block * 2) == 0 else '# ~ #')
+        if i % max(1, int(1 / density)) == 0:
+            out.append('name = "{{project_name}}"  # line {{index + %d}}' % i)
+        else:
+            out.append("plain text line %d with 'quotes' and {braces}" % i)
+    if lines and (lines - 1) // block % 2 == 0:
+        out.append('# ~ #')
+    return '\n'.join(out)
+
+
+def render(code, config_val):
+    lines = []
+    variables = dict(
+        project_name='bench-project', index=1, enabled=True,
+        _lines=lines, _config_val=config_val, _re=re
+    )
+    exec(code, template_globals(), variables)
+    return '\n'.join(lines).strip() + '\n'
+
+
+def bench(content, precompile, renders):
+    config_val = dict(var_regex=r'{{(.*?)}}', comment='#')
+    start = perf_counter()
+    code = compile(translate(content, config_val['comment'], config_val['var_regex'], precompile), '<string>', 'exec')
+    compile_time = perf_counter() - start
+    start = perf_counter()
+    for _ in range(renders):
+        output = render(code, config_val)
+    return compile_time, (perf_counter() - start) / renders, output
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--lines', type=int, default=20000)
+    parser.add_argument('--density', type=float, default=0.5, help='Fraction of lines with expressions')
+    parser.add_argument('--block', type=int, default=50, help='Lines between directives')
+    parser.add_argument('--renders', type=int, default=20)
+    args = parser.parse_args()
+
+    content = make_template(args.lines, args.density, args.block)
+    print('Template: {} lines, {:.1f} KB'.format(args.lines, len(content) / 1024))
+    results = {}
+    for label, precompile in [('legacy', False), ('precompiled', True)]:
+        compile_time, render_time, output = bench(content, precompile, args.renders)
+        results[label] = output
+        print('{:>12}: compile {:8.2f} ms, render {:8.2f} ms'.format(label, compile_time * 1000, render_time * 1000))
+    if results['legacy'] != results['precompiled']:
+        raise SystemExit('Outputs differ between engines')
+    print('Outputs are identical')
+
+
+if __name__ == '__main__':
+    main()
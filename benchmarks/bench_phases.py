@@ -0,0 +1,183 @@
+"""
+Times each phase of a generation on a synthetic template tree and saves the
+results as JSON so runs can be compared between commits.
+
+    python benchmarks/bench_phases.py --files 1000 --output new.json --compare old.json
+"""
+import json
+import resource
+import shutil
+import subprocess
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+from os.path import join, dirname, abspath, getsize, isfile
+from time import perf_counter
+
+from proyo.cache import CompileCache
+from proyo.index import FileTree, load_files
+from proyo.misc import root_dir, generate_alternate_help
+from proyo.output import DirectoryWriter, StaticFile, write_files
+from proyo.proyo import Proyo
+
+from synthetic import add_arguments, make_tree
+
+
+class Phase:
+    def __init__(self):
+        self.seconds = 0.0
+        self.files = 0
+        self.bytes = 0
+        self.peak = 0
+
+    def as_dict(self):
+        return dict(
+            seconds=self.seconds, files=self.files, bytes=self.bytes, peak_kb=self.peak // 1024,
+            files_per_s=self.files / self.seconds if self.seconds else None,
+            mb_per_s=self.bytes / self.seconds / 1e6 if self.seconds else None,
+        )
+
+
+def data_size(data):
+    if isinstance(data, StaticFile):
+        return getsize(data.path)
+    return len(data.encode() if isinstance(data, str) else data)
+
+
+def timed(phases, name, func, measure_memory):
+    if measure_memory:
+        tracemalloc.start()
+    start = perf_counter()
+    result = func()
+    phases[name].seconds += perf_counter() - start
+    if measure_memory:
+        phases[name].peak = max(phases[name].peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return result
+
+
+def run_once(tree, argv, out, cache, jobs, measure_memory):
+    phases = {i: Phase() for i in ['parse', 'help', 'run', 'render', 'write']}
+    render = phases['render']
+    original_gen_file = Proyo._gen_file
+
+    def gen_file(self, content, *args, **kwargs):
+        start = perf_counter()
+        result = original_gen_file(self, content, *args, **kwargs)
+        render.seconds += perf_counter() - start
+        render.files += 1
+        render.bytes += len(content.encode())
+        return result
+
+    parser = ArgumentParser()
+    macros = load_files(join(root_dir, 'macros'), cache)
+    proyo = Proyo(tree, dict(parser=parser), macros, cache, FileTree())
+    timed(phases, 'parse', proyo.parse, measure_memory)
+    for p in proyo.get_leaf_vars('parser'):
+        p.add_argument('project_folder')
+    children = [p for p in proyo.get_all_children() if 'parser' in p]
+    timed(phases, 'help', lambda: [generate_alternate_help(p) for p in children], measure_memory)
+    phases['parse'].files = phases['help'].files = len(children)
+
+    args = parser.parse_args(argv + [out])
+    proyo.set_target(out)
+    proyo.update_global(args=args)
+    Proyo._gen_file = gen_file
+    try:
+        timed(phases, 'run', lambda: proyo.run(jobs=jobs), measure_memory)
+    finally:
+        Proyo._gen_file = original_gen_file
+    sizes = [data_size(i) for i in proyo.files.values()]
+    phases['run'].files = phases['write'].files = len(sizes)
+    phases['run'].bytes = phases['write'].bytes = sum(sizes)
+    timed(phases, 'write', lambda: write_files(proyo.files, DirectoryWriter(out)), measure_memory)
+    return phases
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=dirname(abspath(__file__)), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    print('\n{:>8} {:>12} {:>12} {:>8}'.format('phase', 'baseline', 'current', 'ratio'))
+    regressions = []
+    for name, phase in results['phases'].items():
+        old = baseline['phases'].get(name)
+        if not old or not old['seconds']:
+            continue
+        ratio = phase['seconds'] / old['seconds']
+        print('{:>8} {:>10.1f}ms {:>10.1f}ms {:>7.2f}x'.format(name, old['seconds'] * 1000, phase['seconds'] * 1000, ratio))
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    add_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=3, help='Keep the fastest of this many runs')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--cache', choices=['none', 'cold', 'warm'], default='none', help='Compile cache state')
+    parser.add_argument('--memory', action='store_true', help='Measure peak memory per phase (slower)')
+    parser.add_argument('--output', help='Save results to this JSON file')
+    parser.add_argument('--compare', help='Baseline JSON file to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='Ratio above which --compare fails')
+    args = parser.parse_args()
+
+    config = {k: getattr(args, k) for k in [
+        'files', 'file_size', 'var_density', 'directive_density', 'depth', 'width', 'binary_ratio', 'seed',
+        'jobs', 'cache'
+    ]}
+    work = tempfile.mkdtemp(prefix='proyo-bench-')
+    try:
+        tree = join(work, 'templates')
+        argv = make_tree(tree, **{k: v for k, v in config.items() if k not in ('jobs', 'cache')})
+        best = None
+        for i in range(args.repeat):
+            out = join(work, 'out{}'.format(i))
+            cache_dir = join(work, 'cache') if args.cache != 'none' else None
+            if args.cache == 'cold' and cache_dir:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+            if args.cache == 'warm' and i == 0:
+                run_once(tree, argv, join(work, 'warmup'), CompileCache(cache_dir), 1, False)
+            phases = run_once(tree, argv, out, CompileCache(cache_dir), args.jobs, args.memory)
+            if best is None:
+                best = phases
+            for name, phase in phases.items():
+                if phase.seconds < best[name].seconds:
+                    best[name].seconds = phase.seconds
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    results = dict(
+        commit=git_commit(), config=config,
+        phases={name: phase.as_dict() for name, phase in best.items()},
+        max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    )
+    print('{:>8} {:>10} {:>8} {:>10} {:>10} {:>9}'.format('phase', 'time', 'files', 'files/s', 'MB/s', 'peak'))
+    for name, phase in results['phases'].items():
+        print('{:>8} {:>8.1f}ms {:>8} {:>10} {:>10} {:>7}KB'.format(
+            name, phase['seconds'] * 1000, phase['files'],
+            '{:.0f}'.format(phase['files_per_s']) if phase['files_per_s'] else '-',
+            '{:.2f}'.format(phase['mb_per_s']) if phase['mb_per_s'] else '-',
+            phase['peak_kb'] if args.memory else '-',
+        ))
+    print('Max RSS: {} KB'.format(results['max_rss_kb']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare and isfile(args.compare):
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            raise SystemExit('Regressed phases: ' + ', '.join(regressions))
+
+
+if __name__ == '__main__':
+    main()
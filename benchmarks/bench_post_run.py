@@ -0,0 +1,65 @@
+"""
+Times a "# ![inputs -> outputs] command" post-run step with an offline
+stand-in for a dependency installer, running it once and then restoring
+its outputs from the run cache, and checks both give the same files.
+
+    python benchmarks/bench_post_run.py --packages 2000
+"""
+import os
+import sys
+import tempfile
+from argparse import ArgumentParser
+from os.path import join
+from time import perf_counter
+
+from proyo import commands
+
+STAND_IN = '''
+import os, sys, time
+time.sleep({delay})
+for i in range({packages}):
+    os.makedirs(os.path.join('node_modules', 'pkg%d' % i), exist_ok=True)
+    with open(os.path.join('node_modules', 'pkg%d' % i, 'index.js'), 'w') as f:
+        f.write('module.exports = %d;\\n' % i * 20)
+with open('yarn.lock', 'w') as f:
+    f.write(open('package.json').read())
+'''
+
+
+def snapshot(folder):
+    files = {}
+    for parent, dirs, names in os.walk(folder):
+        for name in names:
+            with open(join(parent, name), 'rb') as f:
+                files[os.path.relpath(join(parent, name), folder)] = f.read()
+    return files
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--packages', type=int, default=500, help='Number of packages the stand-in installs')
+    parser.add_argument('--delay', type=float, default=1.0, help='Seconds the stand-in spends "downloading"')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        os.environ['PROYO_CACHE_DIR'] = join(folder, 'cache')
+        script = join(folder, 'install.py')
+        with open(script, 'w') as f:
+            f.write(STAND_IN.format(delay=args.delay, packages=args.packages))
+        command = '{} {}'.format(sys.executable, script)
+        results = []
+        for label in ['installed', 'restored']:
+            project = join(folder, label)
+            os.makedirs(project)
+            with open(join(project, 'package.json'), 'w') as f:
+                f.write('{"name": "bench", "dependencies": {}}\n')
+            start = perf_counter()
+            commands.cached_call(command, ['package.json'], ['node_modules', 'yarn.lock'], shell=True, cwd=project)
+            print('{:>10}: {:7.3f} s'.format(label, perf_counter() - start))
+            results.append(snapshot(project))
+        if results[0] != results[1]:
+            raise SystemExit('Outputs differ')
+
+
+if __name__ == '__main__':
+    main()
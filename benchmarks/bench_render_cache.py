@@ -0,0 +1,64 @@
+"""
+Times running a synthetic template tree without a render cache, with an
+empty one and with one filled by an earlier run (from memory and from
+disk), and checks every run generates the same files.
+
+    python benchmarks/bench_render_cache.py --files 500
+"""
+import tempfile
+from argparse import ArgumentParser
+from os.path import join
+from time import perf_counter
+
+from proyo.cache import CompileCache, RenderCache
+from proyo.index import FileTree, load_files
+from proyo.misc import root_dir
+from proyo.proyo import Proyo
+from synthetic import add_arguments, make_tree
+
+
+def run_once(tree, argv, out, cache, render_cache):
+    parser = ArgumentParser()
+    proyo = Proyo(tree, dict(parser=parser), load_files(join(root_dir, 'macros'), cache), cache, FileTree())
+    proyo.parse()
+    for p in proyo.get_leaf_vars('parser'):
+        p.add_argument('project_folder')
+    proyo.set_target(out)
+    proyo.update_global(args=parser.parse_args(argv + [out]))
+    proyo.set_render_cache(render_cache)
+    start = perf_counter()
+    proyo.run()
+    return perf_counter() - start, {k: v for k, v in proyo.files.items() if isinstance(v, str)}
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    add_arguments(parser)
+    args = parser.parse_args()
+    options = dict(vars(args))
+
+    with tempfile.TemporaryDirectory() as folder:
+        tree = join(folder, 'templates')
+        argv = make_tree(tree, **options)
+        cache = CompileCache()
+        run_once(tree, argv, join(folder, 'out'), cache, None)  # Compile the templates first
+        memory = RenderCache(join(folder, 'renders'))
+        runs = [
+            ('no cache', None),
+            ('cold', memory),
+            ('memory', memory),
+            ('disk', RenderCache(join(folder, 'renders'))),
+        ]
+        expected = None
+        for label, render_cache in runs:
+            seconds, files = run_once(tree, argv, join(folder, 'out'), cache, render_cache)
+            stats = render_cache.summary() if render_cache else ''
+            print('{:>10}: {:7.1f} ms  {}'.format(label, seconds * 1000, stats))
+            if expected is None:
+                expected = files
+            elif files != expected:
+                raise SystemExit('Outputs differ')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Compares peak memory and time of rendering a large template in memory
+against streaming it block by block, and checks the outputs match. The
+streamed run goes through Proyo._render_path on a cold cache, so it
+includes classifying the file.
+
+    python benchmarks/bench_stream.py --mb 200
+"""
+import os
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+from os.path import join
+from time import perf_counter
+
+from proyo.output import RenderedFile
+from proyo.proyo import Proyo
+
+
+def write_template(filename, size, block):
+    """Fixture-like template: rows of data with a few variables and a directive every block lines"""
+    written = index = 0
+    with open(filename, 'w') as f:
+        f.write('# ~ if enabled:\n-- seed data for {{project_name}}\n# ~ #\n')
+        while written < size:
+            if index % block == 0:
+                f.write('# ~ for copy in range(copies):\n' if index % (block * 2) == 0 else '# ~ #\n')
+            row = "INSERT INTO items VALUES ({}, 'item {}', '{{{{project_name}}}}');\n".format(index, index)
+            written += f.write(row)
+            index += 1
+        if (index - 1) // block % 2 == 0:
+            f.write('# ~ #\n')
+
+
+def measure(func):
+    tracemalloc.start()
+    start = perf_counter()
+    result = func()
+    seconds = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--mb', type=float, default=5, help='Template size in megabytes')
+    parser.add_argument('--block', type=int, default=100000, help='Lines between directives')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        filename = join(folder, 'seed.sql')
+        write_template(filename, int(args.mb * 1e6), args.block)
+        proyo = Proyo(folder, dict(project_name='bench', enabled=True, copies=1), {})
+
+        def in_memory():
+            with open(filename) as f:
+                return proyo._gen_file(f.read(), 'seed.sql', filename)[1]
+
+        def streamed(keep):
+            cold = Proyo(folder, dict(project_name='bench', enabled=True, copies=1), {})
+            cold.stream_size = 0  # Stream whatever the size
+            content = cold._render_path(filename, 'seed.sql', None)[1]
+            if not isinstance(content, RenderedFile):
+                return content
+            try:
+                if keep:
+                    with open(content.path) as f:
+                        return f.read()
+            finally:
+                content.discard()
+
+        print('Template: {:.1f} MB'.format(os.path.getsize(filename) / 1e6))
+        expected, seconds, peak = measure(in_memory)
+        print('{:>10}: {:7.2f} s, peak {:9.1f} MB'.format('in memory', seconds, peak / 1e6))
+        _, seconds, peak = measure(lambda: streamed(keep=False))
+        print('{:>10}: {:7.2f} s, peak {:9.1f} MB'.format('streamed', seconds, peak / 1e6))
+        if streamed(keep=True) != expected:
+            raise SystemExit('Outputs differ')
+
+
+if __name__ == '__main__':
+    main()
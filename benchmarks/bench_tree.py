@@ -0,0 +1,99 @@
+"""
+Compares template tree traversals and global variable updates against the
+original implementations on large synthetic trees of sub-templates.
+
+    python benchmarks/bench_tree.py --width 10 --depth 3
+"""
+from argparse import ArgumentParser
+from os.path import join
+from time import perf_counter
+
+from proyo.index import FileTree
+from proyo.misc import arrange_tree, map_tree
+from proyo.proyo import Proyo
+
+
+class AnyFolder(FileTree):
+    def isdir(self, path):
+        return True
+
+
+def legacy_collect_leaves(tree, val_label='_'):
+    parent_val = tree.pop(val_label, None)
+    if not tree:
+        return [parent_val]
+    return sum([legacy_collect_leaves(val, val_label) for val in tree.values()], [])
+
+
+def legacy_get_all_children(proyo):
+    return [proyo] + sum([legacy_get_all_children(i) for i in proyo.subs.values()], [])
+
+
+def legacy_get_leaf_vars(proyo, var_name):
+    sentinel = object()
+    parser_tree = map_tree(lambda p: p.get_var(var_name, sentinel), arrange_tree(legacy_get_all_children(proyo)))
+    return [i for i in legacy_collect_leaves(dict(parser_tree)) if i is not sentinel]
+
+
+def legacy_update_global(proyo, values, variables):
+    """The original recursion, which copied the values into the dict of every template below"""
+    variables[id(proyo)].update(values, folder=proyo.root, proyo=proyo)
+    for sub in proyo.subs.values():
+        legacy_update_global(sub, values, variables)
+
+
+def make_tree(width, depth):
+    root = Proyo(join('/', 'templates'), dict(parser='root'), {}, tree=AnyFolder())
+    level = [root]
+    for d in range(depth):
+        level = [
+            proyo.sub('t{}'.format(i), parser='{}/{}'.format(proyo['parser'], i))
+            for proyo in level for i in range(width)
+        ]
+    return root
+
+
+def bench(func, repeat):
+    start = perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (perf_counter() - start) / repeat, result
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--width', type=int, default=10, help='Sub-templates per template')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--exports', type=int, default=20, help='Variables set by each update_global()')
+    args = parser.parse_args()
+
+    root = make_tree(args.width, args.depth)
+    print('Templates: {}'.format(len(root.get_all_children())))
+    for label, legacy, current in [
+        ('get_all_children', lambda: legacy_get_all_children(root), root.get_all_children),
+        ('get_leaf_vars', lambda: legacy_get_leaf_vars(root, 'parser'), lambda: root.get_leaf_vars('parser')),
+    ]:
+        legacy_time, legacy_result = bench(legacy, args.repeat)
+        cold_time, cold_result = bench(lambda: (root._invalidate(), current())[1], args.repeat)
+        current_time, current_result = bench(current, args.repeat)
+        if not legacy_result == cold_result == current_result:
+            raise SystemExit('Results of {} differ'.format(label))
+        print('{:>17}: legacy {:9.2f} ms, uncached {:9.2f} ms, cached {:9.2f} ms'.format(
+            label, legacy_time * 1000, cold_time * 1000, current_time * 1000
+        ))
+
+    values = {'export_{}'.format(i): i for i in range(args.exports)}
+    variables = {id(i): dict(i._variables.flat()) for i in root.get_all_children()}
+    legacy_time, _ = bench(lambda: legacy_update_global(root, values, variables), args.repeat)
+    current_time, _ = bench(lambda: root.update_global(values), args.repeat)
+    leaf = root.leaves()[-1]
+    if any(leaf[k] != v for k, v in values.items()):
+        raise SystemExit('Results of update_global differ')
+    print('{:>17}: legacy {:9.2f} ms, current {:9.2f} ms ({} exports)'.format(
+        'update_global', legacy_time * 1000, current_time * 1000, args.exports
+    ))
+
+
+if __name__ == '__main__':
+    main()
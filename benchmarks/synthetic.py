@@ -0,0 +1,113 @@
+"""
+Generates synthetic template trees for benchmarking.
+
+    python benchmarks/synthetic.py /tmp/tree --files 500 --depth 3
+"""
+import os
+import random
+from argparse import ArgumentParser
+from os.path import join
+
+LEAF_SCRIPT = '''from proyo.script_locals import *
+
+parser.add_argument('--flag', action='store_true')
+
+# ~~~
+
+from os.path import basename
+
+project_name = basename(args.project_folder)
+flag = args.flag
+items = list(range(5))
+
+... = project_name
+... = flag
+... = items
+'''
+
+WORDS = ['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'theta', 'lambda']
+
+
+def add_arguments(parser):
+    parser.add_argument('--files', type=int, default=200, help='Template files in the selected leaf')
+    parser.add_argument('--file-size', type=int, default=4096, help='Approximate bytes per template file')
+    parser.add_argument('--var-density', type=float, default=0.2, help='Fraction of lines with a {{...}} expression')
+    parser.add_argument('--directive-density', type=float, default=0.02, help='Fraction of lines starting a # ~ block')
+    parser.add_argument('--depth', type=int, default=2, help='Nesting depth of sub() folders')
+    parser.add_argument('--width', type=int, default=3, help='Sub-templates per folder')
+    parser.add_argument('--binary-ratio', type=float, default=0.05, help='Fraction of binary files')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def template_text(rng, size, var_density, directive_density):
+    lines = []
+    length = 0
+    depth = 0
+    empty_block = False
+    while length < size or empty_block:
+        r = rng.random()
+        if empty_block:
+            line = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 12)))
+            empty_block = False
+        elif r < directive_density:
+            if depth and rng.random() < 0.5:
+                line = '# ~ #'
+                depth -= 1
+            else:
+                line = rng.choice(['# ~ if flag:', '# ~ for i in items:', '# ~ if not flag:'])
+                depth += 1
+                empty_block = True
+        elif r < directive_density + var_density:
+            line = '{} = "{{{{project_name}}}}-{{{{len(items)}}}}"'.format(rng.choice(WORDS))
+        else:
+            line = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 12)))
+        lines.append(line)
+        length += len(line) + 1
+    lines.extend(['# ~ #'] * depth)
+    return '\n'.join(lines) + '\n'
+
+
+def make_tree(folder, files=200, file_size=4096, var_density=0.2, directive_density=0.02,
+              depth=2, width=3, binary_ratio=0.05, seed=0):
+    """Creates a template tree and returns the argv that selects its first leaf"""
+    rng = random.Random(seed)
+    argv = ['gen']
+    os.makedirs(folder, exist_ok=True)
+    open(join(folder, '_.subparsers._'), 'w').close()
+    node = join(folder, 'gen')
+    for level in range(depth):
+        os.makedirs(node, exist_ok=True)
+        open(join(node, '_.subparsers._'), 'w').close()
+        for i in range(width):
+            os.makedirs(join(node, 'n{}'.format(i)), exist_ok=True)
+        node = join(node, 'n0')
+        argv.append('n0')
+    os.makedirs(node, exist_ok=True)
+    for i in range(width):
+        leaf = join(folder, 'gen', *(['n0'] * (depth - 1) + ['n{}'.format(i)])) if depth else node
+        with open(join(leaf, '_._'), 'w') as f:
+            f.write(LEAF_SCRIPT)
+    for i in range(files):
+        subdir = join(node, 'dir{}'.format(i % 10)) if i % 3 else node
+        os.makedirs(subdir, exist_ok=True)
+        if rng.random() < binary_ratio:
+            with open(join(subdir, 'asset{}.bin'.format(i)), 'wb') as f:
+                f.write(b'\xff\xfe\x00' + rng.randbytes(file_size))
+        else:
+            with open(join(subdir, 'file{}.txt'.format(i)), 'w') as f:
+                f.write(template_text(rng, file_size, var_density, directive_density))
+    return argv
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('folder')
+    add_arguments(parser)
+    args = parser.parse_args()
+    options = dict(vars(args))
+    argv = make_tree(options.pop('folder'), **options)
+    print('Select the generated leaf with: {}'.format(' '.join(argv)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import hashlib
+import io
+import json
+import locale
+import marshal
+import mmap
+import os
+import struct
+import sys
+from os.path import join, relpath, basename
+from typing import Dict, List
+
+from proyo.cache import CompileCache
+from proyo.index import FileTree
+from proyo.script import Script
+
+MAGIC = b'PROYOBN1'
+HEADER = struct.Struct('<8sQ')  # Magic and length of the JSON index that follows
+FOLDERS = ['templates', 'macros']
+
+
+def _kind(rel):
+    name = basename(rel)
+    if rel.startswith('macros/'):
+        return 'macro'
+    if name.startswith('_') and name.endswith('_'):
+        return 'script'
+    return 'file'
+
+
+def write_bundle(source: str, filename: str):
+    """
+    Packs the templates and macros below source into one file: a header
+    with a JSON index of every folder and file (offset, size, kind and
+    sha256), followed by the file contents and the compiled scripts.
+    Returns the number of files packed.
+    """
+    dirs: Dict[str, List[str]] = {'.': []}
+    paths = []
+    for folder in FOLDERS:
+        if not os.path.isdir(join(source, folder)):
+            continue
+        dirs['.'].append(folder)
+        for parent, subdirs, names in os.walk(join(source, folder)):
+            subdirs[:] = sorted(i for i in subdirs if i != '__pycache__')
+            names = sorted(i for i in names if not i.endswith('.pyc'))
+            rel = relpath(parent, source)
+            dirs[rel] = sorted(subdirs + names)
+            paths.extend(join(rel, i) for i in names)
+
+    files, chunks, offset = {}, [], 0
+    for rel in paths:
+        with open(join(source, rel), 'rb') as f:
+            data = f.read()
+        files[rel] = [_kind(rel), offset, len(data), hashlib.sha256(data).hexdigest()]
+        chunks.append(data)
+        offset += len(data)
+
+    texts = {}
+    for rel in paths:
+        if files[rel][0] != 'file':
+            with open(join(source, rel)) as f:  # Decoded the same way as when they are loaded
+                texts[rel] = f.read()
+    macros = {basename(rel): text for rel, text in texts.items() if files[rel][0] == 'macro'}
+    scripts = {}
+    for rel, text in texts.items():
+        if files[rel][0] == 'script':
+            macro_text = macros.get(basename(rel), '')
+            scripts[Script.key(text, macro_text)] = tuple(tuple(i) for i in Script._compile(text, macro_text))
+    code = marshal.dumps(scripts)
+    index = dict(
+        dirs=dirs, files=files, code=[offset, len(code)], python=sys.implementation.cache_tag
+    )
+    header = json.dumps(index, sort_keys=True).encode()
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(header)))
+        f.write(header)
+        for data in chunks:
+            f.write(data)
+        f.write(code)
+    os.replace(tmp, filename)
+    return len(files)
+
+
+class SliceReader(io.RawIOBase):
+    """Seekable binary file over part of a memory map"""
+
+    def __init__(self, data, offset, size):
+        self.data = data
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = max(0, min(len(buffer), self.size - self.pos))
+        start = self.offset + self.pos
+        buffer[:count] = self.data[start:start + count]
+        self.pos += count
+        return count
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        self.pos = [pos, self.pos + pos, self.size + pos][whence]
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+
+class BundleTree(FileTree):
+    """
+    Template tree read from a bundle through a memory map, mounted at root
+    so its files have the same paths as the folders it was packed from.
+    """
+
+    def __init__(self, filename: str, root: str):
+        self.filename = filename
+        self.root = root
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError('Not a template bundle: ' + filename)
+        index = json.loads(self.data[HEADER.size:HEADER.size + length].decode())
+        self.start = HEADER.size + length
+        self.dirs: Dict[str, List[str]] = index['dirs']
+        self.files: Dict[str, list] = index['files']
+        self.code = index['code'] if index['python'] == sys.implementation.cache_tag else None
+
+    def preload(self, cache: CompileCache):
+        """Puts the compiled scripts of the bundle into the cache"""
+        if self.code:
+            offset, size = self.code
+            cache.memory.update(marshal.loads(self.data[self.start + offset:self.start + offset + size]))
+
+    def _rel(self, path):
+        return relpath(path, self.root)
+
+    def _entry(self, path):
+        try:
+            return self.files[self._rel(path)]
+        except KeyError:
+            raise FileNotFoundError(path) from None
+
+    def listdir(self, path):
+        try:
+            return list(self.dirs[self._rel(path)])
+        except KeyError:
+            raise FileNotFoundError(path) from None
+
+    def isdir(self, path):
+        return self._rel(path) in self.dirs
+
+    def isfile(self, path):
+        return self._rel(path) in self.files
+
+    def open(self, path, mode='r'):
+        kind, offset, size, sha = self._entry(path)
+        f = io.BufferedReader(SliceReader(self.data, self.start + offset, size))
+        return f if 'b' in mode else io.TextIOWrapper(f)
+
+    def read_bytes(self, path):
+        kind, offset, size, sha = self._entry(path)
+        return self.data[self.start + offset:self.start + offset + size]
+
+    def getsize(self, path):
+        return self._entry(path)[2]
+
+    def stat_key(self, path):
+        return self._entry(path)[3]
+
+    def static_file(self, path, binary):
+        data = self.read_bytes(path)
+        return data if binary else data.decode(locale.getpreferredencoding(False))
+
+    def read_macros(self) -> Dict[str, str]:
+        folder = join(self.root, 'macros')
+        macros = {}
+        for name in self.listdir(folder) if self.isdir(folder) else []:
+            if self.isfile(join(folder, name)):
+                with self.open(join(folder, name)) as f:
+                    macros[name] = f.read()
+        return macros
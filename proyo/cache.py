@@ -0,0 +1,164 @@
+import hashlib
+import marshal
+import os
+import sys
+import threading
+from collections import OrderedDict
+from os.path import join, expanduser, dirname
+from typing import Any, Callable, Optional
+
+from proyo.manifest import render_key
+
+CACHE_VERSION = 5
+
+
+def default_cache_dir() -> Optional[str]:
+    """Cache folder from $PROYO_CACHE_DIR (empty disables it) or the XDG cache dir"""
+    if 'PROYO_CACHE_DIR' in os.environ:
+        return os.environ['PROYO_CACHE_DIR'] or None
+    return join(os.environ.get('XDG_CACHE_HOME') or expanduser('~/.cache'), 'proyo')
+
+
+class CompileCache:
+    """Stores marshalled code objects on disk, similar to __pycache__"""
+
+    def __init__(self, folder: Optional[str] = None):
+        self.folder = folder
+        self.memory = {}
+
+    @staticmethod
+    def key(kind: str, *parts: str) -> str:
+        sha = hashlib.sha256()
+        for part in (sys.implementation.cache_tag, str(CACHE_VERSION), kind) + parts:
+            sha.update(part.encode('utf-8', 'surrogatepass'))
+            sha.update(b'\0')
+        return sha.hexdigest()
+
+    def get(self, key: str, build: Callable[[], Any]) -> Any:
+        if key in self.memory:
+            return self.memory[key]
+        value = self.load(key)
+        if value is None:
+            value = build()
+            self.store(key, value)
+        self.memory[key] = value
+        return value
+
+    def _path(self, key):
+        return join(self.folder, key[:2], key[2:])
+
+    def load(self, key: str) -> Any:
+        if not self.folder:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                return marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def store(self, key: str, value: Any):
+        if not self.folder:
+            return
+        path = self._path(key)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            os.makedirs(dirname(path), exist_ok=True)
+            with open(tmp, 'wb') as f:
+                marshal.dump(value, f)
+            os.replace(tmp, path)
+        except (OSError, ValueError):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+class RenderCache(CompileCache):
+    """
+    Outputs of template renders by a key of the template and the values of
+    the variables it reads (see manifest.render_key), kept in memory up to
+    max_bytes (least recently used first out) and on disk up to max_disk_bytes.
+    """
+
+    def __init__(self, folder: Optional[str] = None, max_bytes=64 << 20, max_disk_bytes=256 << 20, ignore=()):
+        super().__init__(folder and join(folder, str(CACHE_VERSION)))
+        self.memory = OrderedDict()
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.ignore = set(ignore)  # Arguments that don't change renders (like --jobs)
+        self.size = 0
+        self.stats = dict(hits=0, disk_hits=0, misses=0, evictions=0)
+        self.lock = threading.Lock()
+
+    def render_key(self, content, relative, names, variables, config_val) -> Optional[str]:
+        return render_key(content, relative, names, variables, config_val, self.ignore)
+
+    @staticmethod
+    def _size(value) -> int:
+        return len(value[1]) if value else 0
+
+    def lookup(self, key: str) -> Optional[tuple]:
+        """(relative, content) of a previous render, () if it generated no file or None on a miss"""
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.memory.move_to_end(key)
+                self.stats['hits'] += 1
+                return value
+        value = self.load(key)
+        if value is not None:
+            try:
+                os.utime(self._path(key))  # Recently used, for trim()
+            except OSError:
+                pass
+            self._remember(key, value)
+            with self.lock:
+                self.stats['disk_hits'] += 1
+            return value
+        with self.lock:
+            self.stats['misses'] += 1
+        return None
+
+    def put(self, key: str, value: tuple):
+        self._remember(key, value)
+        self.store(key, value)
+
+    def _remember(self, key, value):
+        with self.lock:
+            if key in self.memory:
+                return
+            self.memory[key] = value
+            self.size += self._size(value)
+            while self.size > self.max_bytes and self.memory:
+                _, old = self.memory.popitem(last=False)
+                self.size -= self._size(old)
+                self.stats['evictions'] += 1
+
+    def trim(self):
+        """Removes the least recently used renders from disk until they fit in max_disk_bytes"""
+        if not self.folder:
+            return
+        entries = []
+        for parent, dirs, names in os.walk(self.folder):
+            for name in names:
+                try:
+                    stat = os.stat(join(parent, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, join(parent, name)))
+        total = sum(i[1] for i in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def summary(self) -> str:
+        lookups = self.stats['hits'] + self.stats['disk_hits'] + self.stats['misses']
+        return 'Render cache: {} hits ({} from disk), {} misses, {} evictions, {:.0%} hit rate'.format(
+            self.stats['hits'] + self.stats['disk_hits'], self.stats['disk_hits'], self.stats['misses'],
+            self.stats['evictions'], (lookups - self.stats['misses']) / lookups if lookups else 0
+        )
@@ -0,0 +1,418 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+from argparse import ArgumentParser
+from functools import partial
+from os import getcwd, chdir
+from os.path import join, basename, exists, isfile, realpath, relpath
+from subprocess import call, check_output, CalledProcessError
+from typing import Optional
+
+from proyo.cache import CompileCache, RenderCache, default_cache_dir
+from proyo.index import TreeIndex, load_files
+from proyo.misc import root_dir, generate_alternate_help, arrange_tree, map_tree, collect_leaves, LazyUsageParser
+from proyo.manifest import MANIFEST_NAME, Manifest, UpdateWriter
+from proyo.output import ARCHIVE_FORMATS, DirectoryWriter, ThreadedWriter, archive_writer, write_files
+from proyo.proyo import Proyo
+from proyo.timing import recorder
+
+
+def make_options() -> ArgumentParser:
+    options = ArgumentParser(add_help=False)
+    options.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes to render templates with')
+    options.add_argument('--stream', action='store_true', help='Write files while templates are still rendering')
+    options.add_argument('--lazy', action='store_true', help='Only load the templates named on the command line')
+    options.add_argument('--post-run-jobs', type=int, default=1, metavar='N',
+                         help='Run post-run steps of independent templates in up to N processes')
+    options.add_argument('--update', action='store_true',
+                         help='Update an existing project, leaving files edited since it was generated alone')
+    options.add_argument('--manifest', action='store_true',
+                         help='Save {} in the project so it can be updated later'.format(MANIFEST_NAME))
+    options.add_argument('--only', action='append', metavar='GLOB',
+                         help='Only generate files matching GLOB (into an existing folder too), running the scripts they need')
+    options.add_argument('--exclude', action='append', metavar='GLOB', help='Skip generating files matching GLOB')
+    add_render_cache_argument(options)
+    options.add_argument('--format', choices=ARCHIVE_FORMATS,
+                         help='Stream the project as an archive instead of writing a folder')
+    options.add_argument('--output', metavar='FILE', default='-',
+                         help='Where to write the archive of --format (default: stdout)')
+    options.add_argument('--post-run', action='store_true',
+                         help='Run post-run steps before archiving (in a temporary folder)')
+    options.add_argument('--timings', action='store_true', help='Print time spent in each phase to stderr')
+    options.add_argument('--trace', metavar='FILE', help='Save a Chrome trace of the generation (open in Perfetto)')
+    add_bundle_argument(options)
+    add_store_argument(options)
+    return options
+
+
+def add_bundle_argument(parser: ArgumentParser):
+    parser.add_argument('--bundle', metavar='FILE', default=os.environ.get('PROYO_BUNDLE'),
+                        help='Run the templates packed into FILE by proyo bundle')
+
+
+def add_render_cache_argument(parser: ArgumentParser):
+    parser.add_argument('--render-cache', action='store_true',
+                        help='Reuse files rendered before from the same template and variables')
+
+
+def make_render_cache(ignore=()) -> RenderCache:
+    """Render cache stored in the renders folder of the cache (if it is enabled)"""
+    folder = default_cache_dir()
+    render_cache = RenderCache(folder and join(folder, 'renders'), ignore=ignore)
+    render_cache.trim()
+    return render_cache
+
+
+def add_store_argument(parser: ArgumentParser, hardlinks=True):
+    parser.add_argument('--store', metavar='DIR', default=os.environ.get('PROYO_STORE'),
+                        help='Keep each distinct file once in DIR and reflink or copy it into projects')
+    if hardlinks:
+        parser.add_argument('--store-hardlinks', action='store_true',
+                            help='Hard link files from the store read-only, sharing them between projects '
+                                 '(not with post-run steps, which may change them)')
+
+
+def load_templates(cache: CompileCache, options: ArgumentParser, lazy_argv=None, bundle=None) -> Proyo:
+    """Parses the template tree and sets up the command line of every template"""
+    templates = join(root_dir, 'templates')
+    if bundle:
+        from proyo.bundle import BundleTree
+        tree = BundleTree(bundle, root_dir)
+        tree.preload(cache)
+        macros = tree.read_macros()
+    else:
+        tree = TreeIndex(templates, cache)
+        macros = load_files(join(root_dir, 'macros'), cache)
+    parser = LazyUsageParser(parents=[options])
+    proyo = Proyo(templates, dict(parser=parser), macros, cache, tree)
+    if lazy_argv is not None:
+        proyo.load_lazily(lazy_argv)
+    proyo.parse()
+
+    for p in proyo.get_leaf_vars('parser'):
+        p.add_argument('project_folder')
+
+    for p in proyo.get_all_children():
+        if 'parser' not in p:
+            continue
+        if isinstance(p['parser'], LazyUsageParser):
+            p['parser'].usage_factory = partial(generate_alternate_help, p)
+        else:
+            p['parser'].usage = generate_alternate_help(p)
+    return proyo
+
+
+def batch(argv):
+    parser = ArgumentParser(prog='proyo batch', description='Generates a project for each line of a JSON lines file')
+    parser.add_argument('specs', help='File with lines like {"args": ["create", "python", "script"], '
+                                      '"target": "my-script", "post_run": false}')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='Number of projects to generate at once')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes to render each project with')
+    add_bundle_argument(parser)
+    add_store_argument(parser)
+    add_render_cache_argument(parser)
+    args = parser.parse_args(argv)
+    from concurrent.futures import ThreadPoolExecutor  # Imported lazily to keep startup fast
+
+    with open(args.specs) as f:
+        specs = [json.loads(line) for line in f if line.strip()]
+    options = make_options()
+    proyo = load_templates(CompileCache(default_cache_dir()), options, bundle=args.bundle)
+    if args.render_cache:
+        proyo.set_render_cache(make_render_cache(vars(options.parse_args([]))))
+    writers = []
+    if args.store:
+        from proyo.store import Store, StoreWriter
+        store = Store(args.store, args.store_hardlinks)
+
+    def generate(spec):
+        if exists(spec['target']):
+            return 'Destination already exists'
+        if args.store_hardlinks and spec.get('post_run'):
+            return 'Post-run steps can\'t run on files hard linked from the store'
+        writer = None
+        if args.store:
+            writer = StoreWriter(realpath(spec['target']), store)
+            writers.append(writer)
+        try:
+            generated[spec['target']] = proyo.generate(spec['args'], spec['target'], jobs=args.jobs, writer=writer,
+                                                       only=spec.get('only'), exclude=spec.get('exclude'))
+        except SystemExit:
+            return 'Invalid arguments: ' + ' '.join(spec['args'])
+        except Exception as e:
+            return '{}: {}'.format(e.__class__.__name__, e)
+
+    generated = {}
+    with ThreadPoolExecutor(args.threads) as executor:
+        errors = list(executor.map(generate, specs))
+    for index, spec in enumerate(specs):
+        # Post-run steps fork or change directory, so they run once no other thread is left
+        project = generated.get(spec['target'])
+        if spec.get('post_run') and project and project.selection is None:
+            try:
+                project.post_run_all(jobs=max(args.jobs, 2))
+            except Exception as e:
+                errors[index] = '{}: {}'.format(e.__class__.__name__, e)
+    for spec, error in zip(specs, errors):
+        print('{} {}{}'.format('Failed' if error else 'Generated', spec['target'], ': ' + error if error else ''))
+    if writers:
+        print(StoreWriter.merge(writers).report())
+    if proyo.render_cache:
+        print(proyo.render_cache.summary())
+    if any(errors):
+        exit(1)
+
+
+def serve_command(argv):
+    from proyo.server import default_socket_path, serve
+    parser = ArgumentParser(prog='proyo serve', description='Keeps templates loaded to answer requests on a Unix socket')
+    parser.add_argument('-s', '--socket', default=default_socket_path(), help='Socket to listen on')
+    add_bundle_argument(parser)
+    args = parser.parse_args(argv)
+    cache = CompileCache(default_cache_dir())
+    load = partial(load_templates, cache, make_options(), bundle=args.bundle)
+    serve(args.socket, load, run, [args.bundle] if args.bundle else None)
+
+
+def bundle_command(argv):
+    from proyo.bundle import write_bundle
+    parser = ArgumentParser(prog='proyo bundle', description='Packs the templates and macros into one file to run with --bundle')
+    parser.add_argument('output', help='Bundle file to write')
+    parser.add_argument('-s', '--source', default=root_dir, help='Folder containing the templates and macros folders')
+    args = parser.parse_args(argv)
+    count = write_bundle(args.source, args.output)
+    print('Bundled {} files into {}'.format(count, args.output))
+
+
+def gc_command(argv):
+    from proyo.store import Store
+    parser = ArgumentParser(prog='proyo gc', description='Removes files from the store that no project links to')
+    add_store_argument(parser, hardlinks=False)
+    args = parser.parse_args(argv)
+    if not args.store:
+        parser.error('no store given with --store or PROYO_STORE')
+    count, size = Store(args.store).gc()
+    print('Removed {} files ({} bytes) from {}'.format(count, size, args.store))
+
+
+def watch_command(argv):
+    from proyo.watch import Preview, watch_changes
+    from time import perf_counter
+    options = make_options()
+    options.prog = 'proyo watch'
+    early_args, remaining = options.parse_known_args(argv)
+    if early_args.bundle:
+        print('Templates in a bundle can\'t be watched')
+        exit(1)
+    if early_args.format:
+        print('A watched preview is written to a folder, so it can\'t be used with --format')
+        exit(1)
+    cache = CompileCache(default_cache_dir())
+    preview = None
+    folders = [join(root_dir, 'templates'), join(root_dir, 'macros')]
+    changes = watch_changes(folders)
+    while True:
+        start = perf_counter()
+        proyo = load_templates(cache, options)
+        try:
+            args = proyo['parser'].parse_args(argv)
+        except SystemExit:  # Templates being edited may not accept the arguments yet
+            args = None
+        if args:
+            if preview is None:
+                preview = Preview(realpath(args.project_folder), vars(early_args))
+                print('Watching {} for changes to preview in {}'.format(root_dir, args.project_folder))
+            proyo.set_target(preview.folder)
+            manifest = preview.next_manifest()
+            proyo.set_manifest(manifest)
+            proyo.update_global(args=args)
+            proyo.run(jobs=args.jobs)
+            rendered, written, removed = preview.write(manifest, proyo.files)
+            print('Rendered {} templates in {:.0f} ms, wrote {} of {} files{}'.format(
+                rendered, (perf_counter() - start) * 1000, len(written), len(manifest.files),
+                ''.join('\n    + ' + i for i in written) + ''.join('\n    - ' + i for i in removed)))
+        changed = next(changes)
+        print('Changed: {}'.format(', '.join(sorted(relpath(i, root_dir) for i in changed))))
+
+
+def main():
+    argv = sys.argv[1:]
+    if argv[:1] == ['batch']:
+        return batch(argv[1:])
+    if argv[:1] == ['serve']:
+        return serve_command(argv[1:])
+    if argv[:1] == ['bundle']:
+        return bundle_command(argv[1:])
+    if argv[:1] == ['gc']:
+        return gc_command(argv[1:])
+    if argv[:1] == ['watch']:
+        return watch_command(argv[1:])
+    run(argv)
+
+
+def run(argv, proyo: Optional[Proyo] = None, archive=None):
+    """
+    Generates the project described by argv. A server passes the template
+    tree it already parsed and, when a tar archive was requested, the binary
+    file to stream it to. Otherwise --format streams an archive to --output.
+    """
+    cur_dir = getcwd()
+
+    options = make_options()
+    early_args, remaining = options.parse_known_args(argv)
+    if early_args.update and len(remaining) == 1 and isfile(join(remaining[0], MANIFEST_NAME)):
+        # Reuse the template arguments of the last generation: proyo --update <folder>
+        folder = remaining[0]
+        index = len(argv) - 1 - argv[::-1].index(folder)  # Options may follow the folder
+        remaining = Manifest.load(folder).argv + remaining
+        argv = argv[:index] + argv[index + 1:] + remaining
+    recorder.enabled = early_args.timings or bool(early_args.trace)
+    if archive is None and early_args.format:
+        archive = open_output(early_args.output)
+
+    if proyo is None:
+        cache = CompileCache(default_cache_dir())
+        proyo = load_templates(cache, options, argv if early_args.lazy else None, early_args.bundle)
+    parser = proyo['parser']
+    args = parser.parse_args(argv)
+    if args.render_cache:
+        proyo.set_render_cache(make_render_cache(vars(early_args)))
+
+    chdir(cur_dir)
+    out_folder = realpath(args.project_folder)
+    selecting = bool(args.only or args.exclude)
+    if selecting and (args.update or args.manifest):
+        print('Updates and manifests need every file to be generated, so they can\'t be used with --only or --exclude')
+        exit(1)
+    if archive is not None:
+        if args.update or args.manifest:
+            print('Updates and manifests need the project to be written to a folder')
+            exit(1)
+        if args.post_run and selecting:
+            print('Post-run steps set up a whole project, so they can\'t be used with --only or --exclude')
+            exit(1)
+        try:
+            writer = archive_writer(archive, args.format or 'tar', basename(out_folder))
+        except RuntimeError as e:
+            print(e)
+            if early_args.format and early_args.output != '-':
+                archive.close()
+                os.remove(early_args.output)
+            exit(1)
+        if args.post_run:
+            with tempfile.TemporaryDirectory() as folder:
+                out_folder = join(folder, basename(out_folder))
+                generate_archive(args, proyo, DirectoryWriter(out_folder), out_folder, selecting)
+                chdir(cur_dir)
+                with recorder.span('archive', 'post-run output'):
+                    writer.add_tree(out_folder)
+            writer.close()
+        else:
+            generate_archive(args, proyo, writer, out_folder, selecting)
+        print('Generated {} files for {}'.format(len(proyo.files), args.project_folder))
+        finish_timings(args, proyo)
+        return
+
+    updating = args.update and exists(out_folder)
+    if exists(out_folder) and not updating and not args.only:
+        print('Destination must not exists!')
+        exit(1)
+    if args.store_hardlinks and not updating and not selecting:
+        print('Post-run steps may change files in place, so --store-hardlinks needs --only, --exclude or --update')
+        exit(1)
+
+    if args.store:
+        from proyo.store import Store, StoreWriter
+        writer = store_writer = StoreWriter(out_folder, Store(args.store, args.store_hardlinks))
+    else:
+        writer, store_writer = DirectoryWriter(out_folder), None
+    manifest = None
+    if args.update or args.manifest:
+        manifest = Manifest.load(out_folder, ignore=vars(early_args)) if updating else Manifest(ignore=vars(early_args))
+        writer = UpdateWriter(writer, out_folder, manifest)
+        proyo.set_manifest(manifest)
+    if args.stream:
+        writer = ThreadedWriter(writer)
+        proyo.set_sink(writer)
+
+    proyo.set_target(out_folder)
+    proyo.update_global(args=args)
+    if selecting:
+        proyo.select(args.only, args.exclude)
+    proyo.run(jobs=args.jobs)
+
+    chdir(cur_dir)
+    write_files(proyo.files, writer)
+    if store_writer:
+        print(store_writer.report())
+
+    if manifest is not None:
+        manifest.finish()
+        template_argv = remaining[::-1]
+        template_argv.remove(args.project_folder)
+        variables = {
+            k: v for k, v in vars(args).items()
+            if k not in vars(early_args) and k != 'project_folder' and isinstance(v, (str, int, float, bool, type(None)))
+        }
+        manifest.save(out_folder, template_argv[::-1], variables)
+
+    if updating:
+        if not manifest.found:
+            print('No {} found, so files that differ were left alone'.format(MANIFEST_NAME))
+        for label, files in [('Updated', manifest.written), ('Edited, left alone', manifest.edited),
+                             ('No longer generated', manifest.removed())]:
+            if files:
+                print('{}:{}'.format(label, ''.join('\n    ' + i for i in sorted(files))))
+        print('Updated {}: {} written, {} left alone'.format(
+            args.project_folder, len(manifest.written), len(manifest.edited)))
+        finish_timings(args, proyo)
+        return
+
+    try:
+        with recorder.span('tree', 'tree -C'):
+            tree_output = '\n' + check_output(['tree', '-C', out_folder]).decode().split('\n', 1)[-1]
+    except (CalledProcessError, FileNotFoundError):
+        tree_output = json.dumps(list(proyo.files), indent=2)
+
+    if not selecting:  # Post-run steps set up a whole project
+        proyo.post_run_all(jobs=args.post_run_jobs)
+
+    print('Generated to {}: {}'.format(args.project_folder, tree_output))
+
+    finish_timings(args, proyo)
+
+
+def open_output(path: str):
+    """Binary file for an archive, where - is stdout (printed messages then go to stderr)"""
+    if path != '-':
+        return open(path, 'wb')
+    if sys.stdout.isatty():
+        print('Refusing to write an archive to a terminal, pass --output FILE or redirect stdout')
+        exit(1)
+    sys.stdout.flush()
+    archive = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    return archive
+
+
+def generate_archive(args, proyo: Proyo, writer, out_folder: str, selecting: bool):
+    """Renders into writer, running post-run steps afterwards if asked to"""
+    proyo.set_target(out_folder)
+    proyo.update_global(args=args)
+    if selecting:
+        proyo.select(args.only, args.exclude)
+    proyo.run(jobs=args.jobs)
+    write_files(proyo.files, writer)
+    if args.post_run:
+        proyo.post_run_all(jobs=args.post_run_jobs)
+
+
+def finish_timings(args, proyo: Optional[Proyo] = None):
+    if args.trace:
+        recorder.write_trace(args.trace)
+    if args.timings:
+        print(recorder.summary(), file=sys.stderr)
+        if proyo and proyo.render_cache:
+            print(proyo.render_cache.summary(), file=sys.stderr)
@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+
+from proyo.timing import recorder
+
+capture_output = False  # Set in post-run workers so concurrent output doesn't interleave
+
+
+def check_call(command, **kwargs):
+    """
+    Runs a "# !" command from a script in the current directory. When
+    capturing, its output is printed in one block once it finishes.
+    """
+    kwargs.setdefault('cwd', os.getcwd())
+    with recorder.span('command', command.split(' ')[0], command):
+        if not capture_output:
+            return subprocess.check_call(command, **kwargs)
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+        output = result.stdout.decode(errors='replace').rstrip()
+        if result.returncode:
+            header = '$ {}  (failed with exit code {} in {})'.format(command, result.returncode, kwargs['cwd'])
+        else:
+            header = '$ {}'.format(command)
+        sys.stdout.write(header + ''.join('\n    ' + i for i in output.split('\n') if output) + '\n')
+        sys.stdout.flush()
+        if result.returncode:
+            raise subprocess.CalledProcessError(result.returncode, command, result.stdout)
+        return 0
+
+
+def cached_call(command, inputs, outputs, **kwargs):
+    """
+    Runs a "# ![inputs -> outputs] command" from a script, restoring its
+    outputs from the run cache instead when it already ran on the same inputs.
+    """
+    from proyo.runcache import default_run_cache
+    cache = default_run_cache()
+    if cache is None:
+        return check_call(command, **kwargs)
+    cwd = kwargs.setdefault('cwd', os.getcwd())
+    key = cache.key(command, inputs, cwd)
+    with recorder.span('restore', command.split(' ')[0], command):
+        restored = cache.restore(key, cwd, outputs)
+    if restored:
+        sys.stdout.write('$ {}  (restored {} from cache)\n'.format(command, ', '.join(outputs)))
+        sys.stdout.flush()
+        return 0
+    check_call(command, **kwargs)
+    cache.save(key, cwd, outputs)
+    return 0
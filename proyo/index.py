@@ -0,0 +1,112 @@
+import os
+from os.path import join, dirname, basename
+from typing import Dict, List
+
+from proyo.cache import CompileCache
+from proyo.output import StaticFile
+
+
+class FileTree:
+    """Answers directory queries about a template tree and reads its files straight from the filesystem"""
+
+    def listdir(self, path) -> List[str]:
+        return sorted(os.listdir(path))
+
+    def isdir(self, path) -> bool:
+        return os.path.isdir(path)
+
+    def isfile(self, path) -> bool:
+        return os.path.isfile(path)
+
+    def open(self, path, mode='r'):
+        return open(path, mode)
+
+    def read_bytes(self, path) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def getsize(self, path) -> int:
+        return os.path.getsize(path)
+
+    def stat_key(self, path) -> str:
+        """Changes whenever the content of the file changes (for cache keys)"""
+        stat = os.stat(path)
+        return '{}:{}'.format(stat.st_mtime_ns, stat.st_size)
+
+    def static_file(self, path, binary: bool):
+        """Value of a file that is copied to the target as is"""
+        return StaticFile(path, binary)
+
+
+class TreeIndex(FileTree):
+    """
+    Listing of a template tree persisted in the cache. It is revalidated
+    with one stat per directory since adding, removing or renaming an
+    entry updates the mtime of its directory.
+    """
+
+    def __init__(self, root: str, cache: CompileCache):
+        self.root = root
+        self.cache = cache
+        self.dirs: Dict[str, tuple] = {}
+        key = cache.key('index', root)
+        dirs = cache.load(key)
+        if not isinstance(dirs, dict) or not self._is_fresh(dirs):
+            dirs = self._scan(root, {})
+            cache.store(key, dirs)
+        self.dirs = {path: (mtime, dict(entries)) for path, (mtime, entries) in dirs.items()}
+
+    @staticmethod
+    def _is_fresh(dirs):
+        try:
+            return all(os.stat(path).st_mtime_ns == mtime for path, (mtime, entries) in dirs.items())
+        except OSError:
+            return False
+
+    def _scan(self, path, dirs):
+        mtime = os.stat(path).st_mtime_ns
+        with os.scandir(path) as it:
+            entries = tuple(sorted((i.name, i.is_dir()) for i in it))
+        dirs[path] = (mtime, entries)
+        for name, is_dir in entries:
+            if is_dir:
+                self._scan(join(path, name), dirs)
+        return dirs
+
+    def listdir(self, path):
+        if path in self.dirs:
+            return list(self.dirs[path][1])
+        return super().listdir(path)
+
+    def isdir(self, path):
+        parent = dirname(path)
+        if parent in self.dirs:
+            return self.dirs[parent][1].get(basename(path)) is True
+        return super().isdir(path)
+
+    def isfile(self, path):
+        parent = dirname(path)
+        if parent in self.dirs:
+            return self.dirs[parent][1].get(basename(path)) is False
+        return super().isfile(path)
+
+
+def load_files(folder: str, cache: CompileCache) -> Dict[str, str]:
+    """Reads the text files in a folder, reusing the cached contents while their stats match"""
+    key = cache.key('files', folder)
+    cached = cache.load(key)
+    try:
+        stats = {
+            i.name: (i.stat().st_mtime_ns, i.stat().st_size)
+            for i in os.scandir(folder) if i.is_file()
+        }
+    except OSError:
+        return {}
+    if isinstance(cached, dict) and {name: stat for name, (stat, text) in cached.items()} == stats:
+        return {name: text for name, (stat, text) in cached.items()}
+    files = {}
+    for name in stats:
+        with open(join(folder, name)) as f:
+            files[name] = (stats[name], f.read())
+    cache.store(key, files)
+    return {name: text for name, (stat, text) in files.items()}
@@ -0,0 +1,185 @@
+import hashlib
+import json
+from argparse import Namespace
+from os import makedirs
+from os.path import join, relpath
+from typing import Dict, List, NamedTuple, Optional
+
+from proyo.misc import root_dir
+from proyo.output import RenderedFile, StaticFile
+
+MANIFEST_NAME = '.proyo.json'
+MANIFEST_VERSION = 1
+
+
+class Unchanged(NamedTuple):
+    """Output of a template that was skipped since nothing it reads has changed"""
+    hash: str
+
+
+def data_hash(data) -> str:
+    sha = hashlib.sha256()
+    if isinstance(data, StaticFile):
+        with open(data.path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                sha.update(block)
+    else:
+        sha.update(data.encode() if isinstance(data, str) else data)
+    return sha.hexdigest()
+
+
+def file_hash(path) -> Optional[str]:
+    try:
+        return data_hash(StaticFile(path, True))
+    except OSError:
+        return None
+
+
+def fingerprint(value, ignore=()) -> Optional[str]:
+    """Stable representation of a variable's value, or None if it has none"""
+    if isinstance(value, Namespace):
+        value = {k: v for k, v in vars(value).items() if k not in ignore}
+    text = repr(sorted(value.items()) if isinstance(value, dict) else value)
+    if ' at 0x' in text or ' object>' in text:
+        return None
+    return text
+
+
+def render_key(content, relative, names, variables, config_val, ignore=()) -> Optional[str]:
+    """Key of everything a template render depends on, or None if it can't be known"""
+    if names is None:
+        return None
+    parts = [content, relative, config_val['var_regex'], config_val['comment']]
+    for name in sorted(names):
+        if name in variables:
+            value = fingerprint(variables[name], ignore)
+            if value is None:
+                return None
+            parts.append('{}={}'.format(name, value))
+    return hashlib.sha256('\0'.join(parts).encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+class Manifest:
+    """
+    Record of a generated project stored in it as .proyo.json. It holds a
+    hash of each file as generated and, for each template, a key covering
+    its source and the values of the variables it reads, so an update can
+    skip templates whose key is unchanged and leave edited files alone.
+    """
+
+    def __init__(self, data: Optional[dict] = None, ignore=()):
+        data = data or {}
+        self.found = bool(data)
+        self.previous_files: Dict[str, dict] = data.get('files', {})
+        self.previous_renders: Dict[str, dict] = data.get('renders', {})
+        self.argv: List[str] = data.get('argv', [])
+        self.ignore = set(ignore)
+        self.files: Dict[str, dict] = {}
+        self.renders: Dict[str, dict] = {}
+        self.written: List[str] = []
+        self.edited: List[str] = []
+
+    @classmethod
+    def load(cls, folder, ignore=()) -> 'Manifest':
+        try:
+            with open(join(folder, MANIFEST_NAME)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return cls(ignore=ignore)
+        if data.get('version') != MANIFEST_VERSION:
+            return cls(ignore=ignore)
+        return cls(data, ignore)
+
+    def save(self, folder, argv: List[str], variables: dict):
+        data = dict(
+            version=MANIFEST_VERSION,
+            template_version=template_version(),
+            argv=argv,
+            variables=variables,
+            files=self.files,
+            renders=self.renders,
+        )
+        makedirs(folder, exist_ok=True)  # Nothing else was written if every template failed
+        with open(join(folder, MANIFEST_NAME), 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    def render_key(self, content, relative, names, variables, config_val) -> Optional[str]:
+        return render_key(content, relative, names, variables, config_val, self.ignore)
+
+    def reuse(self, filename, key) -> Optional[tuple]:
+        """(relative, Unchanged) if the template last rendered with the same key on its own"""
+        previous = self.previous_renders.get(self.source_id(filename))
+        if key is None or not previous or previous['key'] != key or not previous['reusable']:
+            return None
+        file = self.previous_files.get(previous['output'])
+        if not file:
+            return None
+        self.record(filename, key, previous['output'], True)
+        return previous['output'], Unchanged(file['hash'])
+
+    def record(self, filename, key, output, reusable):
+        if key is not None:
+            self.renders[self.source_id(filename)] = dict(key=key, output=output, reusable=reusable)
+
+    def get_record(self, filename) -> Optional[dict]:
+        return self.renders.get(self.source_id(filename))
+
+    @staticmethod
+    def source_id(filename):
+        return relpath(filename, root_dir)
+
+    def finish(self):
+        """Only lets outputs produced by a single template be reused next time"""
+        outputs = {}
+        for render in self.renders.values():
+            outputs[render['output']] = outputs.get(render['output'], 0) + 1
+        for render in self.renders.values():
+            if outputs[render['output']] > 1 or render['output'] not in self.files:
+                render['reusable'] = False
+
+    def removed(self) -> List[str]:
+        """Files from the last generation that templates no longer produce"""
+        return sorted(set(self.previous_files) - set(self.files))
+
+
+class UpdateWriter:
+    """
+    Writes a file only if its content changed and it was not edited since
+    the last generation (its hash on disk still matches the manifest).
+    """
+
+    def __init__(self, writer, folder, manifest: Manifest):
+        self.writer = writer
+        self.folder = folder
+        self.manifest = manifest
+
+    def write(self, relative, data):
+        if isinstance(data, Unchanged):
+            self.manifest.files[relative] = dict(hash=data.hash)
+            if file_hash(join(self.folder, relative)) != data.hash:
+                self.manifest.edited.append(relative)  # Deleted or edited without a re-render to compare with
+            return
+        new_hash = data_hash(data)
+        self.manifest.files[relative] = dict(hash=new_hash)
+        disk_hash = file_hash(join(self.folder, relative))
+        if disk_hash != new_hash:
+            previous = self.manifest.previous_files.get(relative)
+            if disk_hash is None and previous is None or previous and disk_hash == previous['hash']:
+                self.writer.write(relative, data)
+                self.manifest.written.append(relative)
+                return
+            self.manifest.edited.append(relative)
+        if isinstance(data, RenderedFile):
+            data.discard()  # Not written
+
+    def close(self):
+        self.writer.close()
+
+
+def template_version() -> str:
+    try:
+        from importlib.metadata import version
+        return version('proyo')
+    except Exception:
+        return 'unknown'
@@ -1,10 +1,11 @@
 import re
+import threading
+from argparse import ArgumentParser
 from copy import deepcopy
 
 from os.path import dirname, abspath, split
-from pkg_resources import resource_filename, Requirement
 
-root_dir = resource_filename(Requirement.parse("proyo"), 'proyo')
+root_dir = dirname(abspath(__file__))
 
 
 def format_tree(obj, val_label, indent=''):
@@ -59,11 +60,14 @@ def arrange_tree(proyos, val_label='_'):
     return root
 
 
-def collect_leaves(tree, val_label='_'):
+def collect_leaves(tree, val_label='_', leaves=None):
+    leaves = [] if leaves is None else leaves
     parent_val = tree.pop(val_label, None)
     if not tree:
-        return [parent_val]
-    return sum([collect_leaves(val, val_label) for val in tree.values()], [])
+        leaves.append(parent_val)
+    for val in tree.values():
+        collect_leaves(val, val_label, leaves)
+    return leaves
 
 
 def map_tree(func, tree):
@@ -127,7 +131,7 @@ def generate_alternate_help(proyo):
     val_label = '_'
     usage_parts = dict(map_tree(
         lambda x: extract_parts(re.sub(r'\s{2,}', ' ', x['parser'].format_usage().split('[-h]')[-1].strip())),
-        arrange_tree(proyo.get_all_children(), val_label)
+        proyo.arrange(val_label)
     ))
     usage_parts = dict(remove_redundant_usage(usage_parts))
     leaves = [set(i) for i in collect_leaves(deepcopy(usage_parts), val_label)] or [set()]
@@ -140,3 +144,31 @@ def generate_alternate_help(proyo):
             (' '.join([''] + list(common))) * (original_parts and original_parts[-1] == '...') +
             ('\n  │\n' + tree_usage) * bool(tree_usage)
     )
+
+
+class LazyUsageParser(ArgumentParser):
+    """
+    ArgumentParser that calls usage_factory for its usage the first time
+    argparse shows it, so commands that don't print usage skip building it.
+    Sub-parsers made with add_subparsers() are of the same class.
+    """
+    _state = threading.local()
+
+    def __init__(self, *args, **kwargs):
+        self.usage_factory = None
+        super().__init__(*args, **kwargs)
+
+    @property
+    def usage(self):
+        # While a factory runs, parsers report their default usage like before they had one
+        if self._usage is None and self.usage_factory and not getattr(self._state, 'building', False):
+            self._state.building = True
+            try:
+                self._usage = self.usage_factory()
+            finally:
+                self._state.building = False
+        return self._usage
+
+    @usage.setter
+    def usage(self, value):
+        self._usage = value
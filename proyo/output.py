@@ -0,0 +1,344 @@
+import io
+import locale
+import os
+import re
+import shutil
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from os import makedirs
+from os.path import join, dirname
+from queue import Queue
+from stat import S_IFDIR, S_IFLNK, S_IFREG, S_IMODE, S_ISDIR, S_ISLNK, S_ISREG
+from threading import Thread
+from typing import NamedTuple
+
+from proyo.timing import recorder
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FICLONE = 0x40049409  # Linux ioctl to share extents between files (reflink)
+UMASK = os.umask(0)
+os.umask(UMASK)
+FILE_MODE = 0o666 & ~UMASK  # Modes of generated files and folders when written to a folder
+DIR_MODE = 0o777 & ~UMASK
+ARCHIVE_FORMATS = ['tar', 'tar.gz', 'tar.zst', 'zip']
+
+
+class StaticFile(NamedTuple):
+    """A template file that is copied to the target as is"""
+    path: str
+    binary: bool
+
+    def read_text(self):
+        with open(self.path) as f:
+            return f.read()
+
+
+class RenderedFile(StaticFile):
+    """A streamed template rendered to a temporary file, which is removed once it is written"""
+    __slots__ = ()
+
+    @classmethod
+    def create(cls):
+        fd, path = tempfile.mkstemp(prefix='proyo-')
+        os.chmod(path, 0o666 & ~UMASK)  # Like files opened for writing
+        return open(fd, 'w'), cls(path, False)
+
+    def read_text(self):
+        try:
+            return super().read_text()
+        finally:
+            self.discard()
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _reflink(fsrc, fdst) -> bool:
+    if fcntl:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError:
+            pass
+    return False
+
+
+def reflink(src, dst) -> bool:
+    """Creates dst sharing the data of src if the filesystem supports it (leaving no file if not)"""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if _reflink(fsrc, fdst):
+            return True
+    os.remove(dst)
+    return False
+
+
+def copy_file(src, dst):
+    """Copies a file without reading it into memory, using a reflink if the filesystem supports it"""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if _reflink(fsrc, fdst):
+            return
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                    pass
+                return
+            except OSError:
+                pass
+    shutil.copyfile(src, dst)  # Uses sendfile where available
+
+
+def may_append(content) -> bool:
+    """Whether a later template could still append to content with a "+++" header"""
+    return isinstance(content, str) and bool(re.match(r'\s*[^\n]*?\s*\+\+\+', content))
+
+
+def write_files(files, writer):
+    """Writes every file that was not already streamed to the writer, then closes it"""
+    for relative, data in files.items():
+        if data is not None:
+            writer.write(relative, data)
+    writer.close()
+
+
+class DirectoryWriter:
+    """Writes generated files below a folder"""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def write(self, relative, data):
+        path = join(self.folder, relative)
+        with recorder.span('write', relative, path) as span:
+            makedirs(dirname(path), exist_ok=True)
+            if isinstance(data, RenderedFile):
+                try:
+                    os.replace(data.path, path)
+                except OSError:  # On another filesystem
+                    copy_file(data.path, path)
+                    data.discard()
+                if recorder.enabled:
+                    span.bytes = os.path.getsize(path)
+                return
+            if isinstance(data, StaticFile):
+                copy_file(data.path, path)
+                if recorder.enabled:
+                    span.bytes = os.path.getsize(path)
+                return
+            fmt = 'wb' if isinstance(data, bytes) else 'w'
+            with open(path, fmt) as f:
+                f.write(data)
+            if recorder.enabled:
+                span.bytes = os.path.getsize(path)  # Encoded size, not the length of the text
+
+    def close(self):
+        pass
+
+
+class ArchiveWriter(ABC):
+    """
+    Streams generated files into an archive below a top level folder,
+    adding an entry for each folder before the files in it. Files get the
+    modes they would have when written to a folder.
+    """
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.mtime = time.time()
+        self.dirs = set()
+
+    def _parents(self, name):
+        parents = []
+        folder = dirname(name)
+        while folder and folder not in self.dirs:
+            parents.append(folder)
+            self.dirs.add(folder)
+            folder = dirname(folder)
+        for folder in reversed(parents):
+            self._add_dir(folder, DIR_MODE, self.mtime)
+
+    def write(self, relative, data):
+        name = join(self.prefix, relative)
+        with recorder.span('write', relative, name) as span:
+            self._parents(name)
+            if isinstance(data, StaticFile):
+                span.bytes = os.path.getsize(data.path)
+                with open(data.path, 'rb') as f:
+                    self._add_file(name, f, span.bytes, FILE_MODE, self.mtime)
+                if isinstance(data, RenderedFile):
+                    data.discard()
+                return
+            data = data.encode(locale.getpreferredencoding(False)) if isinstance(data, str) else data
+            span.bytes = len(data)
+            self._add_file(name, io.BytesIO(data), len(data), FILE_MODE, self.mtime)
+
+    def add_tree(self, folder):
+        """Adds everything below folder as it is on disk (like after post-run steps)"""
+        self._parents(join(self.prefix, 'x'))
+        for parent, dirs, names in os.walk(folder):
+            dirs.sort()
+            for name in sorted(dirs + names):
+                path = join(parent, name)
+                archived = join(self.prefix, os.path.relpath(path, folder))
+                stat = os.lstat(path)
+                if S_ISLNK(stat.st_mode):
+                    self._add_symlink(archived, os.readlink(path), stat.st_mtime)
+                elif S_ISDIR(stat.st_mode):
+                    self.dirs.add(archived)
+                    self._add_dir(archived, S_IMODE(stat.st_mode), stat.st_mtime)
+                elif S_ISREG(stat.st_mode):
+                    with open(path, 'rb') as f:
+                        self._add_file(archived, f, stat.st_size, S_IMODE(stat.st_mode), stat.st_mtime)
+
+    @abstractmethod
+    def _add_dir(self, name, mode, mtime):
+        pass
+
+    @abstractmethod
+    def _add_file(self, name, fileobj, size, mode, mtime):
+        pass
+
+    @abstractmethod
+    def _add_symlink(self, name, target, mtime):
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+
+class TarWriter(ArchiveWriter):
+    """Writes a tar archive (compressed with compression 'gz' or 'zst' if given) to a binary stream"""
+
+    def __init__(self, fileobj, prefix='', compression=''):
+        import tarfile  # Imported lazily to keep startup fast
+        super().__init__(prefix)
+        self.fileobj = fileobj
+        self.stream = zstd_writer(fileobj) if compression == 'zst' else fileobj
+        mode = 'w|gz' if compression == 'gz' else 'w|'
+        self.tar = tarfile.open(fileobj=self.stream, mode=mode, format=tarfile.PAX_FORMAT)
+
+    def _info(self, name, kind, mode, mtime):
+        import tarfile
+        info = tarfile.TarInfo(name)
+        info.type, info.mode, info.mtime = kind, mode, mtime
+        return info
+
+    def _add_dir(self, name, mode, mtime):
+        import tarfile
+        self.tar.addfile(self._info(name, tarfile.DIRTYPE, mode, mtime))
+
+    def _add_file(self, name, fileobj, size, mode, mtime):
+        import tarfile
+        info = self._info(name, tarfile.REGTYPE, mode, mtime)
+        info.size = size
+        self.tar.addfile(info, fileobj)
+
+    def _add_symlink(self, name, target, mtime):
+        import tarfile
+        info = self._info(name, tarfile.SYMTYPE, 0o777, mtime)
+        info.linkname = target
+        self.tar.addfile(info)
+
+    def close(self):
+        self.tar.close()
+        if self.stream is not self.fileobj:
+            self.stream.close()
+        self.fileobj.flush()
+
+
+class ZipWriter(ArchiveWriter):
+    """Writes a zip archive to a binary stream, which doesn't have to be seekable"""
+
+    def __init__(self, fileobj, prefix=''):
+        import zipfile  # Imported lazily to keep startup fast
+        super().__init__(prefix)
+        self.fileobj = fileobj
+        self.zip = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED)
+
+    def _info(self, name, mode, mtime):
+        import zipfile
+        info = zipfile.ZipInfo(name, time.localtime(max(mtime, 315532800))[:6])  # Zip dates start in 1980
+        info.external_attr = mode << 16
+        info.compress_type = zipfile.ZIP_DEFLATED
+        return info
+
+    def _add_dir(self, name, mode, mtime):
+        info = self._info(name + '/', S_IFDIR | mode, mtime)
+        info.external_attr |= 0x10  # MS-DOS directory flag
+        self.zip.writestr(info, b'')
+
+    def _add_file(self, name, fileobj, size, mode, mtime):
+        with self.zip.open(self._info(name, S_IFREG | mode, mtime), 'w', force_zip64=size > 1 << 31) as f:
+            shutil.copyfileobj(fileobj, f, 1 << 16)
+
+    def _add_symlink(self, name, target, mtime):
+        self.zip.writestr(self._info(name, S_IFLNK | 0o777, mtime), target)
+
+    def close(self):
+        self.zip.close()
+        self.fileobj.flush()
+
+
+def zstd_writer(fileobj):
+    """Binary stream compressing into fileobj with zstd (needs Python 3.14 or the zstandard package)"""
+    try:
+        from compression import zstd
+        return zstd.ZstdFile(fileobj, 'w')
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError('Writing .tar.zst needs Python 3.14 or the zstandard package') from None
+    return zstandard.ZstdCompressor().stream_writer(fileobj, closefd=False)
+
+
+def archive_writer(fileobj, archive_format='tar', prefix=''):
+    """Writer for one of ARCHIVE_FORMATS"""
+    if archive_format == 'zip':
+        return ZipWriter(fileobj, prefix)
+    return TarWriter(fileobj, prefix, archive_format.partition('.')[2])
+
+
+class ThreadedWriter:
+    """Passes files to another writer running in a background thread through a bounded queue"""
+
+    def __init__(self, writer, max_pending=16):
+        self.writer = writer
+        self.queue = Queue(max_pending)
+        self.error = None
+        self.thread = Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                try:
+                    self.writer.write(*item)
+                except Exception as e:
+                    self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, relative, data):
+        self._check()
+        self.queue.put((relative, data))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        self._check()
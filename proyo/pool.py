@@ -0,0 +1,97 @@
+import sys
+from typing import Callable, Iterator, List, Set
+
+_payload = None  # Set in each fork_map worker by _set_payload
+
+
+def _set_payload(func, items):
+    global _payload
+    _payload = func, items
+
+
+def _call(index):
+    func, items = _payload
+    return func(items[index])
+
+
+def can_fork() -> bool:
+    import multiprocessing
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+def fork_map(func: Callable, items: List, jobs: int) -> Iterator:
+    """
+    Maps func over items in forked worker processes, yielding results in
+    order. Workers inherit func and items through fork, so only indices and
+    the (picklable) results cross the process boundary.
+    """
+    import multiprocessing  # Imported lazily to keep startup fast
+    from concurrent.futures import ProcessPoolExecutor
+    if jobs <= 1 or len(items) <= 1 or not can_fork():
+        yield from map(func, items)
+        return
+    sys.stdout.flush()
+    sys.stderr.flush()
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(jobs, mp_context=context, initializer=_set_payload, initargs=(func, items)) as executor:
+        yield from executor.map(_call, range(len(items)), chunksize=max(1, len(items) // (jobs * 4)))
+
+
+def _run_node(func, conn):
+    import os
+    import traceback
+    from proyo.timing import recorder
+    code, spans = 1, []
+    try:
+        with recorder.capture() as spans:
+            func()
+        code = 0
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        conn.send(spans)
+        conn.close()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Skip interpreter shutdown, which can fail after forking from a non-main thread
+        os._exit(code)
+
+
+def run_graph(funcs: List[Callable], deps: List[Set[int]], jobs: int):
+    """
+    Calls each function in its own forked process once the functions it
+    depends on (by index) have finished, running up to jobs at a time.
+    """
+    import multiprocessing
+    from multiprocessing.connection import wait
+    from proyo.timing import recorder
+    if jobs <= 1 or not can_fork():
+        for func in funcs:
+            func()
+        return
+    context = multiprocessing.get_context('fork')
+    pending = list(range(len(funcs)))
+    running = {}
+    done = set()
+    while pending or running:
+        for i in [i for i in pending if deps[i] <= done][:jobs - len(running)]:
+            pending.remove(i)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            reader, writer = context.Pipe(duplex=False)
+            process = context.Process(target=_run_node, args=(funcs[i], writer))
+            process.start()
+            writer.close()
+            running[reader] = i, process
+        if not running:
+            raise RuntimeError('Circular dependency between {}'.format(pending))
+        for reader in wait(list(running)):
+            i, process = running.pop(reader)
+            try:
+                recorder.add(reader.recv())
+            except EOFError:
+                pass
+            process.join()
+            if process.exitcode:
+                print('Warning: worker process exited with code {}'.format(process.exitcode))
+            done.add(i)
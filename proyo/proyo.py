@@ -1,15 +1,29 @@
 from argparse import ArgumentParser
 import sys
 
+import locale
+import os
 import re
 import traceback
+from copy import copy
 from enum import Enum
-from os import listdir, chdir, makedirs
-from os.path import join, basename, isdir, isfile, dirname, splitext
+from functools import partial
+from os import chdir, makedirs
+from os.path import join, basename, dirname, realpath, relpath, splitext
 from traceback import print_exc, format_exc
-from typing import Any, List, Optional, Set
+from typing import Any, Dict, List, Optional, Set
 
-from proyo.misc import map_tree, arrange_tree, collect_leaves
+from proyo import commands
+from proyo.cache import CompileCache, RenderCache
+from proyo.index import FileTree
+from proyo.manifest import Manifest, Unchanged
+from proyo.output import DirectoryWriter, RenderedFile, StaticFile, may_append, write_files
+from proyo.pool import can_fork, fork_map, run_graph
+from proyo.scope import Scope
+from proyo.selection import DYNAMIC_WORDS, SIDE_EFFECT_PATTERN, WORD_PATTERN, Selection, file_words
+from proyo.script import Chunk, Script
+from proyo.template import BlockReader, StrippedOutput, classify_file, compile_stream, compile_template, template_globals, referenced_names
+from proyo.timing import recorder
 
 
 class Phase(Enum):
@@ -25,26 +39,43 @@ class ConfigContext:
         self.config = None
 
     def __enter__(self):
-        self.config = dict(self.proyo.config_val)
-        self.proyo.config_val.update(self.config, **self.params)
+        self.config = {i: self.proyo.config_val[i] for i in self.params if i in self.proyo.config_val}
+        self.proyo.config_val.update(self.params)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.proyo.config_val.clear()
-        self.proyo.config_val.update(self.config)
+        for key in self.params:
+            if key in self.config:
+                self.proyo.config_val[key] = self.config[key]
+            else:
+                self.proyo.config_val.pop(key, None)
 
 
 class Proyo:
-    def __init__(self, folder, variables, macros):
+    stream_size = 16 << 20  # Templates larger than this are rendered block by block into a file
+
+    def __init__(self, folder, variables, macros, cache: Optional[CompileCache] = None, tree: Optional[FileTree] = None):
         self.root = folder
         self.target = None
-        self._variables = variables
+        self._variables = variables if isinstance(variables, Scope) else Scope(values=variables)
         self.macros = macros
+        self.cache = cache or CompileCache()
+        self.tree = tree or FileTree()
+        self.parent: Optional[Proyo] = None
+        self._children: Optional[List[Proyo]] = None  # Cached by get_all_children()
+        self._leaves: Optional[List[Proyo]] = None  # Cached by leaves()
         self.update()
         self.config_val = dict(file_exports=None, var_regex=r'{{(.*?)}}', comment='#')
         self.files = {}
         self.ran_files = {}
         self.generated_files = set()
         self.subs = {}
+        self.deferred = None
+        self.sink = None
+        self.manifest: Optional[Manifest] = None
+        self.selection: Optional[Selection] = None
+        self.render_cache: Optional[RenderCache] = None
+        self.lazy_names: Optional[Set[str]] = None
+        self.scripts: Dict[str, Script] = {}
         self.file_exports: Optional[List[str]] = None
 
     def set_target(self, target):
@@ -52,6 +83,38 @@ class Proyo:
         for folder, proyo in self.subs.items():
             proyo.set_target(target)
 
+    def set_sink(self, sink):
+        """Hands files to sink.write(relative, data) as soon as no later template can change them"""
+        self.sink = sink
+        for proyo in self.subs.values():
+            proyo.set_sink(sink)
+
+    def set_manifest(self, manifest: Manifest):
+        """Records renders in manifest and skips templates it shows are unchanged"""
+        self.manifest = manifest
+        for proyo in self.subs.values():
+            proyo.set_manifest(manifest)
+
+    def set_render_cache(self, render_cache: Optional[RenderCache]):
+        """Reuses the output of templates rendered before with the same values of the variables they read"""
+        self.render_cache = render_cache
+        for proyo in self.subs.values():
+            proyo.set_render_cache(render_cache)
+
+    def select(self, only: Optional[List[str]] = None, exclude: Optional[List[str]] = None):
+        """
+        Only renders templates whose output path matches a glob in only (if
+        given) and none in exclude, and only runs the scripts they need.
+        """
+        selection = Selection(only, exclude)
+        selection.scripts = self._needed_scripts(selection)
+        self._set_selection(selection)
+
+    def _set_selection(self, selection: Optional[Selection]):
+        self.selection = selection
+        for proyo in self.subs.values():
+            proyo._set_selection(selection)
+
     def __contains__(self, item):
         return item in self._variables
 
@@ -64,17 +127,89 @@ class Proyo:
     def sub(self, subfolder, **new_vars):
         if subfolder not in self.subs:
             folder = join(self.root, subfolder)
-            if not isdir(folder):
+            if not self.tree.isdir(folder):
                 raise ValueError('Subdirectory does not exist: ' + folder)
-            sub = Proyo(folder, dict(self._variables, **new_vars), self.macros)
+            sub = Proyo(folder, Scope(self._variables, new_vars), self.macros, self.cache, self.tree)
             sub.generated_files = self.generated_files
             sub.config_val = dict(self.config_val)
             sub.files = self.files
             sub.ran_files = self.ran_files
+            sub.deferred = self.deferred
+            sub.sink = self.sink
+            sub.manifest = self.manifest
+            sub.selection = self.selection
+            sub.render_cache = self.render_cache
+            sub.lazy_names = self.lazy_names
+            sub.scripts = self.scripts
+            sub.parent = self
             self.subs[subfolder] = sub
+            self._invalidate()
         self.subs[subfolder].update(**new_vars)
         return self.subs[subfolder]
 
+    def clone(self, parent: Optional['Proyo'] = None) -> 'Proyo':
+        """Copy of this template tree that shares parsed templates but has its own generation state"""
+        proyo = copy(self)
+        if parent is None:
+            proyo.target = None
+            proyo.files = {}
+            proyo.ran_files = {}
+            proyo.generated_files = set()
+            proyo.deferred = None
+            proyo.sink = None
+            proyo.manifest = None
+            proyo.selection = None
+        else:
+            for attr in ['target', 'files', 'ran_files', 'generated_files', 'deferred', 'sink', 'manifest', 'selection']:
+                setattr(proyo, attr, getattr(parent, attr))
+        proyo.parent = parent
+        proyo._children = proyo._leaves = None
+        proyo._variables = self._variables.copy(parent and parent._variables)
+        proyo.update()
+        proyo.config_val = dict(self.config_val)
+        proyo.file_exports = None if self.file_exports is None else list(self.file_exports)
+        proyo.subs = {folder: sub.clone(proyo) for folder, sub in self.subs.items()}
+        return proyo
+
+    def generate(self, argv: List[str], target: str, jobs=1, writer=None, post_run=False,
+                 only: Optional[List[str]] = None, exclude: Optional[List[str]] = None) -> 'Proyo':
+        """
+        Generates a project into target from a clone of this parsed tree, so it
+        can be called many times, including from several threads. Post-run
+        steps run in forked processes to keep the working directory unchanged,
+        so they need fork and should only be asked for while no other thread
+        runs (proyo batch runs them after its threads finish). They are skipped
+        when only some files are generated (see select()).
+        """
+        if post_run and not can_fork():
+            raise RuntimeError('Post-run steps need fork to run without changing the working directory')
+        target = realpath(target)
+        proyo = self.clone()
+        args = proyo['parser'].parse_args(list(argv) + [target])
+        proyo.set_target(target)
+        proyo.update_global(args=args)
+        if only or exclude:
+            proyo.select(only, exclude)
+        proyo.run(jobs=jobs)
+        write_files(proyo.files, writer or DirectoryWriter(target))
+        if post_run and proyo.selection is None:
+            proyo.post_run_all(jobs=max(jobs, 2))
+        return proyo
+
+    def subfolders(self) -> List[str]:
+        return [i for i in self.tree.listdir(self.root) if self.tree.isdir(join(self.root, i))]
+
+    def load_lazily(self, argv: List[str]):
+        """Only load sub-templates named in argv (unless help is requested)"""
+        if '-h' in argv or '--help' in argv:
+            self.lazy_names = None
+        else:
+            self.lazy_names = set(argv)
+
+    def wants(self, subfolder) -> bool:
+        """Whether a sub-template should be loaded for the current command line"""
+        return self.lazy_names is None or subfolder in self.lazy_names
+
     def config(self, **params):
         missing_keys = set(params) - set(self.config_val)
         for key in missing_keys:
@@ -86,30 +221,71 @@ class Proyo:
     def config_as(self, **params):
         return ConfigContext(self, params)
 
-    def get_all_children(self):
-        return [self] + sum([i.get_all_children() for i in self.subs.values()], [])
+    def _invalidate(self):
+        """Clears the cached traversals of this template and its parents after the tree changes"""
+        node = self
+        while node is not None:
+            node._children = node._leaves = None
+            node = node.parent
+
+    def get_all_children(self) -> List['Proyo']:
+        """This template and all its sub-templates, depth first"""
+        if self._children is None:
+            children, stack = [], [self]
+            while stack:
+                node = stack.pop()
+                children.append(node)
+                stack.extend(reversed(list(node.subs.values())))
+            self._children = children
+        return list(self._children)
+
+    def leaves(self) -> List['Proyo']:
+        """Templates with a parser that have no sub-templates with a parser"""
+        if self._leaves is None:
+            children = self.get_all_children()
+            below = {}
+            for node in reversed(children):
+                below[id(node)] = any(below[id(i)] or 'parser' in i for i in node.subs.values())
+            self._leaves = [i for i in children if 'parser' in i and not below[id(i)]]
+        return list(self._leaves)
+
+    def arrange(self, val_label='_') -> dict:
+        """Nested dict of the templates with a parser by folder name (like misc.arrange_tree)"""
+        tree = {val_label: self} if 'parser' in self else {}
+        for name, sub in self.subs.items():
+            child = sub.arrange(val_label)
+            if child:
+                tree[name] = child
+        return tree
 
     def get_leaf_vars(self, var_name: str) -> List[Any]:
         sentinel = object()
-        parser_tree = map_tree(lambda p: p.get_var(var_name, sentinel), arrange_tree(self.get_all_children()))
-        return [i for i in collect_leaves(dict(parser_tree)) if i is not sentinel]
+        return [i for i in (p.get_var(var_name, sentinel) for p in self.leaves()) if i is not sentinel]
 
     @property
     def leaf_parsers(self) -> List[ArgumentParser]:
         return self.get_leaf_vars('parser')
 
     def update(self, val=None, **params):
-        self._variables.update(val or {}, **params, folder=self.root, proyo=self)
+        had_parser = 'parser' in self._variables
+        self._variables.update(dict(val or {}, **params, folder=self.root, proyo=self))
+        if not had_parser and 'parser' in self._variables:
+            self._invalidate()
 
     def update_global(self, val=None, **params):
-        self.update(val, **params)
-        for sub in self.subs.values():
-            sub.update_global(val, **params)
+        """Updates the variables of this template and every template below it"""
+        values = dict(val or {}, **params)
+        self._variables.broadcast(values)
+        self.update()
+        if 'parser' in values:
+            for proyo in self.get_all_children():
+                proyo._leaves = None
+            self._invalidate()
 
     def parse(self):
-        for i in sorted(listdir(self.root)):
+        for i in self.tree.listdir(self.root):
             filename = join(self.root, i)
-            if isfile(filename) and i.startswith('_.') and i.endswith('._'):
+            if self.tree.isfile(filename) and i.startswith('_.') and i.endswith('._'):
                 try:
                     self._parse_file(filename)
                 except Exception:
@@ -120,17 +296,35 @@ class Proyo:
     def only_collect(self, files: List[str]):
         self.file_exports = files
 
-    def run(self, subpath=''):
+    def run(self, subpath='', jobs=1):
+        """Runs scripts and renders templates, optionally rendering in a pool of jobs processes"""
+        if jobs > 1 and self.deferred is None:
+            self._set_deferred([])
+            try:
+                self.run(subpath)
+            finally:
+                tasks = self.deferred
+                self._set_deferred(None)
+            for task, (result, spans, render) in zip(tasks, fork_map(Proyo._render_task, tasks, jobs)):
+                recorder.add(spans)
+                if render:
+                    self.manifest.record(task[1], **render)
+                if result:
+                    self._add_file(*result, comment=task[4]['comment'])
+            return
+
         parent = join(self.root, subpath) if subpath else self.root
         files_to_generate = set()
-        for i in sorted(listdir(parent)):
+        for i in self.tree.listdir(parent):
             if i == '__pycache__' or i.endswith('.pyc'):
                 continue
             filename = join(parent, i)
-            if isdir(filename):
+            if self.tree.isdir(filename):
                 self.run(join(subpath, i))
             else:
                 if i.startswith('_') and i.endswith('_'):
+                    if self.selection and filename not in self.selection.scripts:
+                        continue
                     if not subpath:  # Only run files in root dir
                         self.ran_files[filename] = self
                         self._run_file(filename)
@@ -143,78 +337,190 @@ class Proyo:
             file_exports = []
         for filename in file_exports:
             relative = join(subpath, basename(filename))
-            try:
-                with open(filename) as f:
-                    self._gen_file(f.read(), relative, filename)
-            except UnicodeDecodeError:
-                with open(filename, 'rb') as f:
-                    data = f.read()
-                if relative not in self.files:
-                    self.files[relative] = data
-            except Exception:
-                print('Failed to generate {}: {}'.format(filename, ''.join(
-                    '\n    ' + i for i in format_exc().split('\n'))))
-
-    def post_run_all(self):
-        for filename, proyo in self.ran_files.items():
+            if self.selection and not self._selected(relative):
+                continue
+            if self.deferred is not None:
+                self.deferred.append((self, filename, relative, self._variables.flat(), dict(self.config_val)))
+                continue
+            result = self._render_path(filename, relative, self._variables.flat())
+            if result:
+                self._add_file(*result, comment=self.config_val['comment'])
+
+    def _selected(self, relative) -> bool:
+        """Whether the output path of a template matches the selection, filling in the variables in it"""
+        var_regex = self.config_val['var_regex']
+        if not all(self._variables.get(var) for var in re.findall(var_regex, relative)):
+            return False  # Not generated anyway
+        try:
+            relative = re.sub(var_regex, lambda m: str(eval(m.group(1), self._variables.flat())), relative)
+        except Exception:
+            return True  # Let rendering report the error
+        return self.selection.matches(relative)
+
+    def _needed_scripts(self, selection: Selection) -> Set[str]:
+        """
+        Scripts to run for the templates a selection could render: the ones
+        with side effects (using proyo or running commands) and the ones
+        exporting a variable named in those templates or in the imports of
+        other needed scripts. Names are looked up as words in the template
+        text since run scripts can change the syntax templates are compiled with.
+        """
+        roots = sorted((p.root for p in self.get_all_children()), key=len, reverse=True)
+        var_regex = self.config_val['var_regex']
+        names, chunks, dynamic = set(), {}, False
+        folders = [self.root]
+        while folders:
+            folder = folders.pop()
+            for i in self.tree.listdir(folder):
+                filename = join(folder, i)
+                if i == '__pycache__' or i.endswith('.pyc'):
+                    continue
+                if self.tree.isdir(filename):
+                    folders.append(filename)
+                elif i.startswith('_') and i.endswith('_'):
+                    if folder in roots:
+                        chunks[filename] = self._script(filename).chunks[1]
+                else:
+                    root = next(r for r in roots if filename.startswith(join(r, '')))
+                    relative = relpath(filename, root)
+                    if selection.may_match(relative, var_regex):
+                        with self.tree.open(filename, 'rb') as f:
+                            words = set(WORD_PATTERN.findall(relative)) | file_words(f)
+                        dynamic = dynamic or bool(words & DYNAMIC_WORDS)
+                        names |= words
+        if dynamic:
+            return set(chunks)
+        needed, changed = set(), True
+        while changed:
+            changed = False
+            for filename, chunk in chunks.items():
+                if filename not in needed and (SIDE_EFFECT_PATTERN.search(chunk.source) or names & set(chunk.exports)):
+                    needed.add(filename)
+                    names |= set(chunk.imports)
+                    changed = True
+        return needed
+
+    def _set_deferred(self, deferred):
+        self.deferred = deferred
+        for sub in self.subs.values():
+            sub._set_deferred(deferred)
+
+    @staticmethod
+    def _render_task(task):
+        proyo, filename, relative, variables, config_val = task
+        current = dict(proyo.config_val)
+        proyo.config_val.clear()
+        proyo.config_val.update(config_val)
+        try:
+            with recorder.capture() as spans:
+                result = proyo._render_path(filename, relative, variables)
+            return result, spans, proyo.manifest and proyo.manifest.get_record(filename)
+        finally:
+            proyo.config_val.clear()
+            proyo.config_val.update(current)
+
+    def _classify(self, filename):
+        var_regex, comment = self.config_val['var_regex'], self.config_val['comment']
+        key = self.cache.key('kind', filename, self.tree.stat_key(filename), var_regex, comment)
+
+        def classify():
+            with self.tree.open(filename, 'rb') as f:
+                return classify_file(f, comment, var_regex)
+        return self.cache.get(key, classify)
+
+    def _render_path(self, filename, relative, variables):
+        try:
+            kind = self._classify(filename)
+            if kind == 'binary':
+                return relative, self.tree.static_file(filename, True)
+            if kind == 'static' and not re.search(self.config_val['var_regex'], relative):
+                return relative, self.tree.static_file(filename, False)
+            if self.tree.getsize(filename) > self.stream_size:
+                return self._gen_stream(relative, filename, variables)
+            with self.tree.open(filename) as f:
+                return self._gen_file(f.read(), relative, filename, variables)
+        except UnicodeDecodeError:
+            return relative, self.tree.static_file(filename, True)
+        except Exception:
+            print('Failed to generate {}: {}'.format(filename, ''.join(
+                '\n    ' + i for i in format_exc().split('\n'))))
+
+    def _add_file(self, relative, content, comment=None):
+        if isinstance(content, StaticFile) and relative in self.files:
+            if content.binary:
+                return
+            content = content.read_text()
+        if isinstance(content, (bytes, StaticFile, Unchanged)):
+            if relative in self.files:
+                return
+        elif relative in self.files:
+            existing_content = self.files[relative]
+            if not isinstance(existing_content, str):
+                return
+            m = re.match(r'^\s*' + (comment or '') + r'\s*\+\+\+', existing_content)
+            if not m:
+                return
+            content = content + '\n' + existing_content[m.end():].strip()
+        if self.sink and not may_append(content):
+            self.sink.write(relative, content)
+            content = None  # Keep the path so later templates for it are still skipped
+        self.files[relative] = content
+
+    def post_run_all(self, jobs=1):
+        """
+        Runs the post-run part of each script. With jobs > 1, scripts run in
+        separate processes, each one after the scripts of its own and parent
+        templates so only independent sub-templates overlap. Variables
+        exported by a process are lost, so scripts exporting any run in order.
+        """
+        scripts = list(self.ran_files.items())
+        exporting = [i for i, _ in scripts if self._script(i).chunks[2].exports]
+        if jobs > 1 and exporting:
+            print('Post-run steps of {} export variables, so post-run steps run one at a time'.format(
+                ', '.join(relpath(i, self.root) for i in exporting)))
+            jobs = 1
+        capture = jobs > 1 and can_fork()
+        funcs, deps = [], []
+        for index, (filename, proyo) in enumerate(scripts):
             src_sub = dirname(filename)
             if not src_sub.startswith(proyo.root):
                 raise RuntimeError('Invalid template source: ' + src_sub)
             target_sub = self.target + src_sub[len(proyo.root):]
-            makedirs(target_sub, exist_ok=True)
-            chdir(target_sub)
-
-            Proyo._post_run_file(proyo, filename)
-
-    def _load_text(self, filename):
-        base = basename(filename)
-        if base in self.macros:
-            return self.macros[base]
-        with open(filename) as f:
-            return f.read()
-
-    def _extract_part_text(self, text, part_id):
-        parts = re.split(r'^\s*#\s*~{3,}.*', text, flags=re.MULTILINE)
-        if len(parts) > part_id:
-            return parts[part_id]
-        return None
-
-    def _extract_part(self, filename, part_id):
-        with open(filename) as f:
-            file_text = f.read()
-        base = basename(filename)
-        if base in self.macros:
-            macro_text = self.macros[base]
-        else:
-            macro_text = ''
-        file_part = self._extract_part_text(file_text, part_id)
-        macro_part = self._extract_part_text(macro_text, part_id)
-        return '\n'.join([macro_part or '', file_part or ''])
-
-    def _parse_file(self, filename, ):
-        part = self._extract_part(filename, 0)
-        if part is None:
-            return
-        self._run_chunk('parsing', part, filename, Phase.PARSE)
+            funcs.append(partial(Proyo._post_run_in, proyo, filename, target_sub, capture))
+            deps.append({
+                i for i, (_, other) in enumerate(scripts[:index])
+                if proyo.root == other.root or proyo.root.startswith(join(other.root, ''))
+            })
+        with recorder.span('post-run total', 'post_run_all'):
+            run_graph(funcs, deps, jobs)
+
+    def _post_run_in(self, filename, folder, capture=False):
+        """Runs the post-run part of a script in folder, restoring the working directory after"""
+        makedirs(folder, exist_ok=True)
+        cur_dir, captured = os.getcwd(), commands.capture_output
+        chdir(folder)  # Scripts are plain Python that may use relative paths
+        commands.capture_output = capture
+        try:
+            self._post_run_file(filename)
+        finally:
+            chdir(cur_dir)
+            commands.capture_output = captured
+
+    def _script(self, filename) -> Script:
+        if filename not in self.scripts:
+            with self.tree.open(filename) as f:
+                text = f.read()
+            self.scripts[filename] = Script.load(filename, text, self.macros.get(basename(filename), ''), self.cache)
+        return self.scripts[filename]
+
+    def _parse_file(self, filename):
+        self._run_chunk('parsing', self._script(filename).chunks[0], filename, Phase.PARSE)
 
     def _run_file(self, filename):
-        part = self._extract_part(filename, 1)
-        if part is None:
-            return
-        self._run_chunk('running', part, filename, Phase.RUN)
+        self._run_chunk('running', self._script(filename).chunks[1], filename, Phase.RUN)
 
     def _post_run_file(self, filename):
-        part = self._extract_part(filename, 2)
-        if part is None:
-            return
-        self._run_chunk('post-running', part, filename, Phase.POST_RUN)
-
-    def _convert_bash_cmd(self, match):
-        command = match.group(2)
-        exe = command.split(' ')[0]
-        command = command.replace("'", r"\'")
-        command = re.sub(r'(?<!\\){(.*?)(?<!\\)}', r"''' + str(\1) + '''", command)
-        return match.group(1) + "__import__('shutil').which('" + exe + "') and __import__('subprocess').check_call('''" + command + "''', shell=True)"
+        self._run_chunk('post-running', self._script(filename).chunks[2], filename, Phase.POST_RUN)
 
     def _extract_system_imports(self, system_import_contents: List[str]) -> Set[str]:
         """Extracts the "default" set of script imports from script_locals.py"""
@@ -225,26 +531,21 @@ class Proyo:
                 system_imports.update({k for k, v in vars(script_locals).items() if v is ...})
         return {x for x in system_imports if x in self._variables}
 
-    def _run_chunk(self, action, chunk, label, phase: Phase):
-        import_matches = list(re.finditer(r'^\s*([a-zA-Z_][a-zA-Z_0-9]*)(?::\s*[a-zA-Z_][a-zA-Z_0-9]*)?\s*=\s*\.\.\.\s*', chunk, re.MULTILINE))
-        # Match "from proyo.script_locals import *" or "from proyo.script_locals import (\na, b, c)" type statements
-        system_import_matches = list(re.finditer(r'^\s*from\s+proyo\.script_locals\s+import\s*((?:\s*\*\s*|\s*\(\s*[a-zA-Z_][a-zA-Z_0-9]*(?:\s*,\s*[a-zA-Z_][a-zA-Z_0-9]*)*\s*\)|\s*(?:[a-zA-Z_][a-zA-Z_0-9]*\s*,\s*)*[a-zA-Z_][a-zA-Z_0-9]*))\s*', chunk, re.MULTILINE))
-        export_matches = list(re.finditer(r'^\s*\.\.\.\s*=\s*([a-zA-Z_][a-zA-Z_0-9]*)\s*', chunk, re.MULTILINE))
-        imports = {str(i.group(1)) for i in import_matches} | self._extract_system_imports(['*'])
-        exports = {str(i.group(1)) for i in export_matches}
+    def _run_chunk(self, action, chunk: Chunk, label, phase: Phase):
+        imports, exports, chunk, code = chunk
+        imports = set(imports) | self._extract_system_imports(['*'])
+        exports = set(exports)
 
         not_found = imports - set(self._variables)
         if not_found:
             print('Warning when {} {}: Could not resolve variables: {}'.format(action, label, ', '.join(not_found)))
             return
 
-        spans = [(0, 0)] + sorted([i.span() for i in import_matches + system_import_matches + export_matches]) + [(len(chunk), len(chunk))]
-        chunk = ''.join(chunk[b:c] for (a, b), (c, d) in zip(spans, spans[1:]))
-        chunk = re.sub(r'^(\s*)#\s*!(.*)', self._convert_bash_cmd, chunk, flags=re.MULTILINE)
-
-        variables = {i: self._variables[i] for i in imports}
+        visible = self._variables.flat()
+        variables = {i: visible[i] for i in imports}
         try:
-            exec(chunk, {}, variables)
+            with recorder.span(action, basename(label), label):
+                exec(chunk if code is None else code, {}, variables)
             extra_exports = exports - set(variables)
             if extra_exports:
                 raise NameError("Could not resolve variables: {}".format(extra_exports))
@@ -288,70 +589,126 @@ class Proyo:
             }
         }[phase]
 
-    def _gen_file(self, content, relative, filename):
+    def _compile_template(self, content):
+        var_regex, comment = self.config_val['var_regex'], self.config_val['comment']
+        key = self.cache.key('template', content, var_regex, comment)
+        return self.cache.get(key, lambda: compile_template(content, comment, var_regex))
+
+    def _compile_stream(self, filename):
+        var_regex, comment = self.config_val['var_regex'], self.config_val['comment']
+        key = self.cache.key('stream', filename, self.tree.stat_key(filename), var_regex, comment)
+
+        def build():
+            with self.tree.open(filename) as f:
+                return compile_stream(f, comment, var_regex)
+        return self.cache.get(key, build)
+
+    def _gen_file(self, content, relative, filename, variables=None):
+        variables = self._variables.flat() if variables is None else variables
         path_vars = re.findall(self.config_val['var_regex'], relative)
-        if not all(self._variables.get(var) for var in path_vars):
+        if not all(variables.get(var) for var in path_vars):
             return  # Skip generating templates with empty variable names
 
-        exec_lines = []
-        in_between = []
-        indent = ''
-
-        def flush_between():
-            if in_between:
-                eval_code = (
-                    "_lines.append(_re.sub("
-                    "   _config_val['var_regex'],"
-                    "   lambda m, _vars=locals(): str(eval(m.group(1), {{}}, _vars)),"
-                    "   '''{}'''"
-                    "))"
-                )
-                exec_lines.append(indent + eval_code.format(
-                    '\n'.join(in_between).replace(r"'", r"\'").replace("'''", "''' + \"'''\" + '''")
-                ))
-                in_between.clear()
-
-        for line in content.split('\n'):
-            if re.match(r'\s*' + self.config_val['comment'] + '\s*~', line):
-                code_line = line.split('~', 1)[-1].strip()
-                flush_between()
-                if code_line == '#':
-                    if not indent:
-                        print_exc()
-                        print('Error when generating {}: Too many unindents'.format(relative))
-                        return
-                    indent = indent[1:]
-                else:
-                    exec_lines.append(indent + code_line)
-                    if code_line.endswith(':'):
-                        indent += ' '
-            else:
-                in_between.append(line)
-        flush_between()
-        if indent:
+        try:
+            code = self._compile_template(content)
+        except ValueError as e:
+            print('Error when generating {}: {}'.format(relative, e))
+            return
+        except SyntaxError as e:
             print_exc()
-            print('Error when generating {}: {} indents remaining at end of file'.format(relative, len(indent)))
+            print('Error when generating {}, {}: {}'.format(relative, e.__class__.__name__, str(e)))
             return
 
-        variables = dict(self._variables)
+        key = cache_key = names = None
+        if (self.manifest is not None or self.render_cache is not None) and not path_vars:
+            names = referenced_names(code)
+        if self.manifest is not None and not path_vars:
+            key = self.manifest.render_key(content, relative, names, variables, self.config_val)
+            reused = self.manifest.reuse(filename, key)
+            if reused:
+                return reused
+        if self.render_cache is not None and not path_vars:
+            cache_key = self.render_cache.render_key(content, relative, names, variables, self.config_val)
+            cached = cache_key and self.render_cache.lookup(cache_key)
+            if cached is not None:
+                if not cached:
+                    return None
+                if self.manifest is not None:
+                    self.manifest.record(filename, key, cached[0], not may_append(cached[1]))
+                return cached
+
+        variables = dict(variables)
         variables['_lines'] = lines = []
         variables['_config_val'] = self.config_val
         variables['_re'] = re
 
+        with recorder.span('render', relative, filename) as span:
+            try:
+                exec(code, template_globals(), variables)
+            except Exception as e:
+                print_exc()
+                print('Error when generating {}, {}: {}'.format(relative, e.__class__.__name__, str(e)))
+                return
+            if not any(i.strip() for i in lines) and len(lines) <= 1:
+                if cache_key:
+                    self.render_cache.put(cache_key, ())
+                return
+            relative = re.sub(self.config_val['var_regex'], lambda m: str(eval(m.group(1), variables)), relative)
+            content = '\n'.join(lines).strip() + '\n'
+            if recorder.enabled:
+                span.bytes = len(content.encode(locale.getpreferredencoding(False), 'replace'))
+        if cache_key:
+            self.render_cache.put(cache_key, (relative, content))
+        if self.manifest is not None:
+            self.manifest.record(filename, key, relative, not may_append(content))
+        return relative, content
+
+    def _gen_stream(self, relative, filename, variables=None):
+        """
+        Renders a large template like _gen_file() without holding it in
+        memory. Literal blocks are read from the template as they are
+        reached and the output goes to a temporary file.
+        """
+        variables = self._variables.flat() if variables is None else variables
+        path_vars = re.findall(self.config_val['var_regex'], relative)
+        if not all(variables.get(var) for var in path_vars):
+            return
+
         try:
-            exec('\n'.join(exec_lines), {}, variables)
-        except Exception as e:
+            code, blocks = self._compile_stream(filename)
+        except ValueError as e:
+            print('Error when generating {}: {}'.format(relative, e))
+            return
+        except SyntaxError as e:
             print_exc()
             print('Error when generating {}, {}: {}'.format(relative, e.__class__.__name__, str(e)))
             return
-        if not any(i.strip() for i in lines) and len(lines) <= 1:
-            return
-        relative = re.sub(self.config_val['var_regex'], lambda m: str(eval(m.group(1), variables)), relative)
-        content = '\n'.join(lines).strip() + '\n'
-        if relative in self.files:
-            existing_content = self.files[relative]
-            m = re.match(r'^\s*' + (self.config_val['comment'] or '') + r'\s*\+\+\+', existing_content)
-            if m:
-                self.files[relative] = content + '\n' +  existing_content[m.end():].strip()
-        else:
-            self.files[relative] = content
+
+        variables = dict(variables)
+        variables['_config_val'] = self.config_val
+        variables['_re'] = re
+
+        out, content = RenderedFile.create()
+        rendered = False
+        try:
+            with recorder.span('render', relative, filename) as span:
+                with out, self.tree.open(filename) as source:
+                    variables['_lines'] = lines = StrippedOutput(out)
+                    template_vars = dict(template_globals(), _block=BlockReader(source, blocks, self.config_val['var_regex']))
+                    try:
+                        exec(code, template_vars, variables)
+                    except Exception as e:
+                        print_exc()
+                        print('Error when generating {}, {}: {}'.format(relative, e.__class__.__name__, str(e)))
+                        return
+                    if not lines.close():
+                        return
+                relative = re.sub(self.config_val['var_regex'], lambda m: str(eval(m.group(1), variables)), relative)
+                span.bytes = os.path.getsize(content.path)
+            rendered = True
+        finally:
+            if not rendered:
+                content.discard()
+        if lines.may_append() is not False:
+            content = content.read_text()  # Later templates may append to it, which needs it in memory
+        return relative, content
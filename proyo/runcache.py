@@ -0,0 +1,101 @@
+import hashlib
+import os
+import platform
+import shutil
+import sys
+from os import makedirs
+from os.path import join, lexists, isdir, islink, relpath
+from typing import List, Optional
+
+from proyo.output import copy_file
+
+
+def copy_with_mode(src, dst):
+    """
+    Copies src to dst with its mode. The copy is a reflink where the
+    filesystem supports it, but never a hard link, so changing a restored
+    file (like package.json after a later yarn add) leaves the cache alone.
+    """
+    copy_file(src, dst)
+    shutil.copymode(src, dst)
+
+
+def copy_tree(src, dst):
+    """Recreates a file or folder at dst with copies of the files below src, keeping symlinks"""
+    if islink(src):
+        os.symlink(os.readlink(src), dst)
+    elif not isdir(src):
+        copy_with_mode(src, dst)
+    else:
+        for parent, dirs, names in os.walk(src):
+            target = join(dst, relpath(parent, src))
+            makedirs(target, exist_ok=True)
+            for name in names + [i for i in dirs if islink(join(parent, i))]:
+                copy_tree(join(parent, name), join(target, name))
+
+
+def remove(path):
+    if isdir(path) and not islink(path):
+        shutil.rmtree(path)
+    elif lexists(path):
+        os.remove(path)
+
+
+class RunCache:
+    """
+    Outputs of "# !" commands saved by the hash of their inputs, so the
+    same command on the same inputs (like installing the dependencies of
+    an identical package.json) is restored instead of run again.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+
+    @staticmethod
+    def key(command: str, inputs: List[str], cwd: str) -> str:
+        sha = hashlib.sha256()
+        exe = shutil.which(command.split(' ')[0]) or ''
+        for part in [command, exe, sys.platform, platform.machine()]:
+            sha.update(part.encode('utf-8', 'surrogatepass') + b'\0')
+        for name in sorted(inputs):
+            sha.update(name.encode('utf-8', 'surrogatepass') + b'\0')
+            try:
+                with open(join(cwd, name), 'rb') as f:
+                    sha.update(hashlib.sha256(f.read()).digest())
+            except FileNotFoundError:
+                sha.update(b'missing')
+        return sha.hexdigest()
+
+    def _entry(self, key):
+        return join(self.folder, key[:2], key[2:])
+
+    def restore(self, key: str, cwd: str, outputs: List[str]) -> bool:
+        entry = self._entry(key)
+        if not isdir(entry):
+            return False
+        for name in outputs:
+            remove(join(cwd, name))
+            if lexists(join(entry, name)):
+                makedirs(join(cwd, os.path.dirname(name)), exist_ok=True)
+                copy_tree(join(entry, name), join(cwd, name))
+        return True
+
+    def save(self, key: str, cwd: str, outputs: List[str]):
+        entry = self._entry(key)
+        tmp = '{}.{}.tmp'.format(entry, os.getpid())
+        remove(tmp)
+        makedirs(tmp)
+        for name in outputs:
+            if lexists(join(cwd, name)):
+                makedirs(join(tmp, os.path.dirname(name)), exist_ok=True)
+                copy_tree(join(cwd, name), join(tmp, name))
+        try:
+            os.rename(tmp, entry)
+        except OSError:  # Saved by another process meanwhile
+            shutil.rmtree(tmp)
+
+
+def default_run_cache() -> Optional[RunCache]:
+    from proyo.cache import default_cache_dir
+    folder = default_cache_dir()
+    return RunCache(join(folder, 'runs')) if folder else None
@@ -0,0 +1,105 @@
+from itertools import count
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+_clock = count(1)  # Orders writes across all scopes
+_MISSING = object()
+
+
+class Scope:
+    """
+    Variables of a template layered on the scope of its parent template.
+    Writes are stamped so update_global() only has to store its values
+    once, as broadcast values of the scope it is called on: templates
+    below see them unless they set their own value afterwards.
+
+    A template used to start with a copy of its parent's variables, so
+    before update() changes a value that a sub-template inherits, the
+    sub-template keeps the value it had (copy on write).
+    """
+
+    def __init__(self, parent: Optional['Scope'] = None, values: Optional[dict] = None):
+        self.parent = parent
+        self.top: Scope = parent.top if parent else self
+        self.children = []
+        self.local: Dict[str, Tuple[Any, int]] = {}  # Value and stamp of variables set here
+        self.shared: Dict[str, Tuple[Any, int]] = {}  # Values broadcast to every scope below
+        self.changed = 0  # Stamp of the last write in the tree (only kept on the top scope)
+        self._flat: Optional[dict] = None
+        self._flat_at = -1
+        if parent:
+            parent.children.append(self)
+        if values:
+            self.update(values)
+
+    def _lookup(self, key) -> Tuple[Any, int]:
+        """Visible value and its stamp: the closest value set by update() or any newer broadcast one"""
+        best = (_MISSING, -1)
+        node, nearest = self, True
+        while node is not None:
+            if nearest and key in node.local:
+                nearest = False
+                if node.local[key][1] > best[1]:
+                    best = node.local[key]
+            entry = node.shared.get(key)
+            if entry is not None and entry[1] > best[1]:
+                best = entry
+            node = node.parent
+        return best
+
+    def __getitem__(self, key):
+        value = self._lookup(key)[0]
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._lookup(key)[0] is not _MISSING
+
+    def get(self, key, default=None):
+        value = self._lookup(key)[0]
+        return default if value is _MISSING else value
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.flat())
+
+    def update(self, values: dict):
+        for child in self.children:
+            for key in values:
+                if key not in child.local:
+                    child.local[key] = child._lookup(key)
+        for key, value in values.items():
+            self.local[key] = (value, next(_clock))
+        self.top.changed = next(_clock)
+
+    def broadcast(self, values: dict):
+        """Sets values here and in every scope below"""
+        for key, value in values.items():
+            self.shared[key] = (value, next(_clock))
+        self.top.changed = next(_clock)
+
+    def flat(self) -> dict:
+        """
+        All visible variables as a dict. It is cached until a variable in
+        the tree changes and must not be modified.
+        """
+        if self._flat_at != self.top.changed:
+            chain, node = [], self
+            while node is not None:
+                chain.append(node)
+                node = node.parent
+            flat = {}
+            for node in reversed(chain):
+                for key in list(node.local) + list(node.shared):
+                    if key not in flat:
+                        flat[key] = self._lookup(key)[0]
+            flat = {k: v for k, v in flat.items() if v is not _MISSING}
+            self._flat, self._flat_at = flat, self.top.changed
+        return self._flat
+
+    def copy(self, parent: Optional['Scope'] = None) -> 'Scope':
+        """Scope with the same values on another parent, for a cloned template tree"""
+        scope = Scope(parent)
+        scope.local = dict(self.local)
+        scope.shared = dict(self.shared)
+        scope.top.changed = next(_clock)
+        return scope
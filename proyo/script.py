@@ -0,0 +1,94 @@
+import re
+from types import CodeType
+from typing import List, NamedTuple, Optional, Tuple
+
+from proyo.cache import CompileCache
+
+PHASE_SEPARATOR = re.compile(r'^\s*#\s*~{3,}.*', re.MULTILINE)
+IMPORT_PATTERN = re.compile(r'^\s*([a-zA-Z_][a-zA-Z_0-9]*)(?::\s*[a-zA-Z_][a-zA-Z_0-9]*)?\s*=\s*\.\.\.\s*', re.MULTILINE)
+# Match "from proyo.script_locals import *" or "from proyo.script_locals import (\na, b, c)" type statements
+SYSTEM_IMPORT_PATTERN = re.compile(r'^\s*from\s+proyo\.script_locals\s+import\s*((?:\s*\*\s*|\s*\(\s*[a-zA-Z_][a-zA-Z_0-9]*(?:\s*,\s*[a-zA-Z_][a-zA-Z_0-9]*)*\s*\)|\s*(?:[a-zA-Z_][a-zA-Z_0-9]*\s*,\s*)*[a-zA-Z_][a-zA-Z_0-9]*))\s*', re.MULTILINE)
+EXPORT_PATTERN = re.compile(r'^\s*\.\.\.\s*=\s*([a-zA-Z_][a-zA-Z_0-9]*)\s*', re.MULTILINE)
+BASH_PATTERN = re.compile(r'^(\s*)#\s*!(.*)', re.MULTILINE)
+RUN_CACHE_PATTERN = re.compile(r'^\s*\[([^\]]*?)->([^\]]*)\]\s*')
+
+
+class Chunk(NamedTuple):
+    """One phase of a script with its "x = ..." imports and "... = x" exports removed"""
+    imports: Tuple[str, ...]
+    exports: Tuple[str, ...]
+    source: str
+    code: Optional[CodeType]  # None if it has a syntax error, which is raised again when executed
+
+
+def parse_paths(text: str) -> List[str]:
+    return [i.strip() for i in text.split(',') if i.strip()]
+
+
+def convert_bash_cmd(match):
+    command = match.group(2)
+    cached = RUN_CACHE_PATTERN.match(command)
+    if cached:  # "# ![inputs -> outputs] command" restores the outputs when the inputs didn't change
+        command = command[cached.end():]
+    exe = command.split(' ')[0]
+    command = command.replace("'", r"\'")
+    command = re.sub(r'(?<!\\){(.*?)(?<!\\)}', r"''' + str(\1) + '''", command)
+    if cached:
+        inputs, outputs = parse_paths(cached.group(1)), parse_paths(cached.group(2))
+        call = "cached_call('''" + command + "''', " + repr(inputs) + ", " + repr(outputs) + ", "
+    else:
+        call = "check_call('''" + command + "''', "
+    return match.group(1) + "__import__('shutil').which('" + exe + "') and __import__('proyo.commands').commands." + call + "shell=True)"
+
+
+def compile_chunk(chunk: str) -> Chunk:
+    import_matches = list(IMPORT_PATTERN.finditer(chunk))
+    system_import_matches = list(SYSTEM_IMPORT_PATTERN.finditer(chunk))
+    export_matches = list(EXPORT_PATTERN.finditer(chunk))
+    imports = tuple(sorted({str(i.group(1)) for i in import_matches}))
+    exports = tuple(sorted({str(i.group(1)) for i in export_matches}))
+
+    spans = [(0, 0)] + sorted([i.span() for i in import_matches + system_import_matches + export_matches]) + [(len(chunk), len(chunk))]
+    chunk = ''.join(chunk[b:c] for (a, b), (c, d) in zip(spans, spans[1:]))
+    chunk = BASH_PATTERN.sub(convert_bash_cmd, chunk)
+    try:
+        code = compile(chunk, '<string>', 'exec')
+    except SyntaxError:
+        code = None
+    return Chunk(imports, exports, chunk, code)
+
+
+def split_phases(text: str, count: int) -> List[Optional[str]]:
+    parts = PHASE_SEPARATOR.split(text)
+    return [parts[i] if i < len(parts) else None for i in range(count)]
+
+
+class Script:
+    """
+    A _.*._ script read once and split into its parse, run and post-run
+    phases, each merged with the macro of the same name and compiled.
+    """
+    PHASES = 3
+
+    def __init__(self, filename: str, chunks: List[Chunk]):
+        self.filename = filename
+        self.chunks = chunks
+
+    @classmethod
+    def load(cls, filename: str, file_text: str, macro_text: str, cache: CompileCache) -> 'Script':
+        key = cls.key(file_text, macro_text)
+        chunks = cache.get(key, lambda: tuple(tuple(i) for i in cls._compile(file_text, macro_text)))
+        return cls(filename, [Chunk(*i) for i in chunks])
+
+    @staticmethod
+    def key(file_text: str, macro_text: str) -> str:
+        return CompileCache.key('script', macro_text, file_text)
+
+    @classmethod
+    def _compile(cls, file_text, macro_text):
+        file_parts = split_phases(file_text, cls.PHASES)
+        macro_parts = split_phases(macro_text, cls.PHASES)
+        return [
+            compile_chunk('\n'.join([macro_part or '', file_part or '']))
+            for macro_part, file_part in zip(macro_parts, file_parts)
+        ]
@@ -0,0 +1,60 @@
+import codecs
+import re
+from fnmatch import fnmatchcase
+from os.path import dirname, basename
+from typing import List, Optional, Set
+
+WORD_PATTERN = re.compile(r'[a-zA-Z_][a-zA-Z_0-9]*')
+SIDE_EFFECT_PATTERN = re.compile(r'\bproyo\b')  # Scripts using proyo (or "# !" commands) change more than their exports
+DYNAMIC_WORDS = {'eval', 'exec', 'vars', 'globals', 'locals'}
+
+
+def file_words(f, block_size: int = 1 << 20) -> Set[str]:
+    """Words in a binary file, read in blocks so only the set of distinct words is kept in memory"""
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    words, carry = set(), ''
+    while True:
+        data = f.read(block_size)
+        text = carry + decoder.decode(data, final=not data)
+        carry = ''
+        if data:
+            m = re.search(r'[a-zA-Z_0-9]*$', text)  # A word may continue in the next block
+            text, carry = text[:m.start()], text[m.start():]
+        words.update(WORD_PATTERN.findall(text))
+        if not data:
+            return words
+
+
+def glob_matches(path: str, pattern: str) -> bool:
+    """
+    Whether a relative path matches a glob. Like .gitignore, a pattern
+    without a slash matches a file or folder name at any depth and a
+    pattern matching a folder selects everything below it.
+    """
+    pattern = pattern.strip('/')
+    while path:
+        if fnmatchcase(path, pattern) or ('/' not in pattern and fnmatchcase(basename(path), pattern)):
+            return True
+        path = dirname(path)
+    return False
+
+
+class Selection:
+    """Globs choosing which generated files to render, set with Proyo.select()"""
+
+    def __init__(self, only: Optional[List[str]] = None, exclude: Optional[List[str]] = None):
+        self.only = list(only or [])
+        self.exclude = list(exclude or [])
+        self.scripts: Optional[Set[str]] = None  # Scripts needed by the selected templates
+
+    def matches(self, relative: str) -> bool:
+        if self.only and not any(glob_matches(relative, i) for i in self.only):
+            return False
+        return not any(glob_matches(relative, i) for i in self.exclude)
+
+    def may_match(self, relative: str, var_regex: str) -> bool:
+        """Whether a template path could match once the variables in it are filled in"""
+        if not re.search(var_regex, relative):
+            return self.matches(relative)
+        shape = re.sub(var_regex, '*', relative)
+        return not self.only or any(glob_matches(shape, i) or glob_matches(i, shape) for i in self.only)
@@ -0,0 +1,167 @@
+import array
+import json
+import os
+import signal
+import socket
+import sys
+from os.path import join
+from typing import Callable, List, Optional
+
+FD_COUNT = 3  # stdin, stdout and stderr of the client
+
+
+def default_socket_path() -> str:
+    return os.environ.get('PROYO_SERVER') or join(
+        os.environ.get('XDG_RUNTIME_DIR') or '/tmp', 'proyo-{}.sock'.format(os.getuid())
+    )
+
+
+def _read_line(conn, data=b''):
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(1 << 16)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def request(socket_path: str, argv: List[str], archive=False, cwd=None, env=None, fds=(0, 1, 2)) -> Optional[int]:
+    """
+    Runs a proyo command line on a server, passing it the file descriptors
+    to use as stdin, stdout and stderr. With archive, a tar of the project
+    is written to stdout instead of a folder. Returns the exit code, or
+    None if no server is listening.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    with sock:
+        message = json.dumps(dict(
+            argv=list(argv), archive=archive, cwd=cwd or os.getcwd(), env=dict(os.environ if env is None else env)
+        )).encode() + b'\n'
+        sent = sock.sendmsg([message], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+        sock.sendall(message[sent:])
+        response = _read_line(sock)
+    try:
+        return json.loads(response.decode())['exit']
+    except (ValueError, KeyError):
+        return 1  # The worker died before answering
+
+
+def template_stamp(folders: List[str]) -> list:
+    """Modification times of the folders and scripts that a parsed template tree depends on"""
+    stamp = []
+    for folder in folders:
+        try:
+            stamp.append((folder, os.stat(folder).st_mtime_ns))
+            with os.scandir(folder) as it:
+                entries = sorted(it, key=lambda x: x.name)
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir():
+                stamp.extend(template_stamp([entry.path]))
+            elif entry.name.startswith('_') and entry.name.endswith('_'):
+                stamp.append((entry.path, entry.stat().st_mtime_ns))
+    return stamp
+
+
+def _reap():
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0]:
+            pass
+    except ChildProcessError:
+        pass
+
+
+def serve(socket_path: str, load: Callable, run: Callable, folders: Optional[List[str]] = None):
+    """
+    Keeps the template tree from load() in memory and answers each request
+    on the socket with run(argv, proyo, archive) in a forked process.
+    Templates are reloaded when their folders or scripts (or the given
+    files, like a bundle) change.
+    """
+    from proyo.misc import root_dir
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        if probe.connect_ex(socket_path) == 0:
+            print('A server is already listening on {}'.format(socket_path))
+            sys.exit(1)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)  # Left behind by a server that was killed
+
+    folders = folders or [join(root_dir, 'templates'), join(root_dir, 'macros')]
+    stamp = template_stamp(folders)
+    proyo = load()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(socket_path)
+    sock.listen(64)
+    sock.settimeout(1.0)  # Wake up regularly to reap finished workers
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # Still remove the socket
+    print('Listening on {}'.format(socket_path))
+    try:
+        while True:
+            _reap()
+            try:
+                conn, _ = sock.accept()
+            except socket.timeout:
+                continue
+            new_stamp = template_stamp(folders)
+            if new_stamp != stamp:
+                stamp, proyo = new_stamp, load()
+                print('Reloaded templates')
+            sys.stdout.flush()
+            sys.stderr.flush()
+            if os.fork() == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                sock.close()
+                _handle(conn, proyo, run)
+            conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        os.remove(socket_path)
+
+
+def _handle(conn, proyo, run):
+    """Runs one request in a forked worker with the client's descriptors, directory and environment"""
+    code = 1
+    try:
+        conn.settimeout(None)
+        data, ancdata, _, _ = conn.recvmsg(1 << 16, socket.CMSG_SPACE(FD_COUNT * array.array('i').itemsize))
+        fds = array.array('i')
+        for level, kind, payload in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+        message = json.loads(_read_line(conn, data).decode())
+        for target, fd in zip(range(FD_COUNT), fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        os.chdir(message['cwd'])
+        os.environ.clear()
+        os.environ.update(message['env'])
+        archive = None
+        if message.get('archive'):
+            archive = os.fdopen(os.dup(1), 'wb')
+            os.dup2(2, 1)  # Keep printed messages out of the archive
+        try:
+            run(message['argv'], proyo, archive)
+            code = 0
+        except SystemExit as e:
+            if isinstance(e.code, str):
+                print(e.code, file=sys.stderr)
+            code = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            conn.sendall(json.dumps(dict(exit=code)).encode() + b'\n')
+        except OSError:
+            pass
+        os._exit(0)
@@ -0,0 +1,178 @@
+import hashlib
+import locale
+import os
+import threading
+import time
+from os import makedirs
+from os.path import join, dirname, exists
+from typing import Tuple
+
+from proyo.output import UMASK, RenderedFile, StaticFile, copy_file, reflink
+
+READ_ONLY = 0o444 & ~UMASK  # Mode of hard linked objects, so writing to them in place fails
+from proyo.timing import recorder
+
+
+def _digest_file(path) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class Store:
+    """
+    Content addressed folder of generated files. Each distinct content is
+    stored once below objects/ and placed into projects as a reflink where
+    the filesystem allows it and as a copy otherwise. With hardlink, objects
+    are instead hard linked into projects read-only, so the projects share
+    the file (and must not change it in place).
+    """
+
+    def __init__(self, folder: str, hardlink=False):
+        self.folder = folder
+        self.hardlink = hardlink
+
+    def object_path(self, digest: str) -> str:
+        return join(self.folder, 'objects', digest[:2], digest[2:])
+
+    def add(self, data) -> Tuple[str, int, bool]:
+        """Stores data unless it already is, returning its object, its size and whether it was new"""
+        if isinstance(data, StaticFile):
+            digest, size, raw = _digest_file(data.path), os.path.getsize(data.path), None
+        else:
+            raw = data.encode(locale.getpreferredencoding(False)) if isinstance(data, str) else data
+            digest, size = hashlib.sha256(raw).hexdigest(), len(raw)
+        path = self.object_path(digest)
+        if exists(path) and not self._modified(path, digest, size):
+            if isinstance(data, RenderedFile):
+                data.discard()
+            return path, size, False
+        makedirs(dirname(path), exist_ok=True)
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        if isinstance(data, RenderedFile):
+            try:
+                os.replace(data.path, tmp)
+            except OSError:  # On another filesystem
+                copy_file(data.path, tmp)
+                data.discard()
+        elif isinstance(data, StaticFile):
+            copy_file(data.path, tmp)
+        else:
+            with open(tmp, 'wb') as f:
+                f.write(raw)
+        stamp = int(time.time()) * 10 ** 9
+        os.utime(tmp, ns=(stamp, stamp))  # Whole seconds mark the object as unmodified
+        os.replace(tmp, path)  # Concurrent writers of the same object are fine
+        return path, size, True
+
+    @staticmethod
+    def _modified(path, digest, size) -> bool:
+        """
+        Whether a project changed the object in place through a hard link.
+        Writes leave a time with a fraction of a second, so only those
+        objects are hashed again. A changed object is unlinked from the
+        store, leaving the projects linked to it as they are.
+        """
+        stat = os.stat(path)
+        if stat.st_size == size and stat.st_mtime_ns % 10 ** 9 == 0:
+            return False
+        if stat.st_size == size and _digest_file(path) == digest:
+            return False
+        try:
+            os.remove(path)
+        except FileNotFoundError:  # Removed by another thread
+            pass
+        return True
+
+    def place(self, obj: str, path: str) -> str:
+        """Puts an object at path, returning 'reflink', 'hardlink' or 'copy'"""
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            if self.hardlink and self._link(obj, tmp):
+                how = 'hardlink'
+            elif reflink(obj, tmp):
+                how = 'reflink'
+            else:
+                copy_file(obj, tmp)
+                how = 'copy'
+            os.replace(tmp, path)  # Never writes into an existing file that may be linked
+        except BaseException:
+            if exists(tmp):
+                os.remove(tmp)
+            raise
+        return how
+
+    @staticmethod
+    def _link(obj: str, path: str) -> bool:
+        if os.stat(obj).st_mode & 0o777 != READ_ONLY:
+            os.chmod(obj, READ_ONLY)
+        try:
+            os.link(obj, path)
+            return True
+        except OSError:  # On another filesystem or not supported
+            return False
+
+    def gc(self) -> Tuple[int, int]:
+        """
+        Removes objects no project hard links to anymore, returning how many
+        and their size. Reflinked and copied files share no inode with their
+        object, so this removes every object not placed with hardlink.
+        """
+        count = size = 0
+        objects = join(self.folder, 'objects')
+        for parent, dirs, names in os.walk(objects):
+            for name in names:
+                path = join(parent, name)
+                stat = os.stat(path)
+                if stat.st_nlink == 1 and not name.endswith('.tmp'):
+                    os.remove(path)
+                    count += 1
+                    size += stat.st_size
+        return count, size
+
+
+class StoreWriter:
+    """Writes generated files below a folder through a store"""
+
+    def __init__(self, folder, store: Store):
+        self.folder = folder
+        self.store = store
+        self.lock = threading.Lock()
+        self.files = self.bytes = self.written = 0  # Written counts bytes that took new space
+        self.placed = dict(reflink=0, hardlink=0, copy=0)
+
+    def write(self, relative, data):
+        path = join(self.folder, relative)
+        with recorder.span('write', relative, path) as span:
+            makedirs(dirname(path), exist_ok=True)
+            obj, size, new = self.store.add(data)
+            how = self.store.place(obj, path)
+            span.bytes = size
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+            self.written += size * new + size * (how == 'copy')
+            self.placed[how] += 1
+
+    def close(self):
+        pass
+
+    @classmethod
+    def merge(cls, writers) -> 'StoreWriter':
+        """Writer with the summed statistics of several writers, to report them together"""
+        total = cls(None, None)
+        for writer in writers:
+            total.files += writer.files
+            total.bytes += writer.bytes
+            total.written += writer.written
+            for how, count in writer.placed.items():
+                total.placed[how] += count
+        return total
+
+    def report(self) -> str:
+        return 'Store: {} files ({}), {} bytes of {} written, {} bytes saved'.format(
+            self.files, ', '.join('{} {}'.format(v, k) for k, v in self.placed.items() if v),
+            self.written, self.bytes, self.bytes - self.written
+        )
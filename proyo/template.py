@@ -0,0 +1,366 @@
+import ast
+import codecs
+import locale
+import re
+from functools import lru_cache
+from typing import List, Optional, Set
+
+from proyo.output import may_append
+
+LEGACY_BLOCK = (
+    "_re.sub("
+    "   _config_val['var_regex'],"
+    "   lambda m, _vars=locals(): str(eval(m.group(1), {{}}, _vars)),"
+    "   {}"
+    ")"
+)
+
+
+def escape_block(lines: List[str]) -> str:
+    """Literal that the original engine used for a run of template lines"""
+    return "'''{}'''".format(
+        '\n'.join(lines).replace(r"'", r"\'").replace("'''", "''' + \"'''\" + '''")
+    )
+
+
+def split_block(text: str, var_regex: str) -> list:
+    """Splits text into literal strings and {{...}} expression sources (as 1-tuples)"""
+    segments = []
+    pos = 0
+    for m in re.finditer(var_regex, text):
+        segments.append(text[pos:m.start()])
+        segments.append((m.group(1),))
+        pos = m.end()
+    segments.append(text[pos:])
+    return segments
+
+
+@lru_cache(maxsize=4096)
+def check_expression(source: str):
+    compile(source, '<string>', 'eval')
+
+
+def substitute(var_regex: str, text: str, variables) -> str:
+    """Renders {{...}} expressions in text the way the original engine did"""
+    return re.sub(var_regex, lambda m: str(eval(m.group(1), {}, variables)), text)
+
+
+def compile_block(lines: List[str], var_regex: str) -> str:
+    """
+    Expression that renders a run of template lines. Each {{...}} is inlined
+    so it is compiled with the rest of the template instead of being
+    evaluated from a string at render time. The regex can change mid-render
+    through proyo.config_as(), so substitute() is kept as a fallback for
+    that case.
+    """
+    literal = escape_block(lines)
+    try:
+        text = ast.literal_eval(literal)
+    except (SyntaxError, ValueError):
+        return LEGACY_BLOCK.format(literal)
+    fallback = "_substitute(_config_val['var_regex'], {!r}, locals())".format(text)
+    try:
+        segments = split_block(text, var_regex)
+        for segment in segments:
+            if isinstance(segment, tuple):
+                check_expression(segment[0])
+    except (SyntaxError, ValueError, IndexError, re.error):
+        return fallback
+    if len(segments) == 1:
+        fast = repr(text)
+    else:
+        fast = "''.join(({},))".format(', '.join(
+            '_str((\n{}\n))'.format(i[0]) if isinstance(i, tuple) else repr(i)
+            for i in segments if i != ''
+        ))
+    return "{} if _config_val['var_regex'] == {!r} else {}".format(fast, var_regex, fallback)
+
+
+def translate(content: str, comment: str, var_regex: str, precompile: bool = True) -> str:
+    """
+    Converts a template into Python source that appends rendered blocks to
+    _lines. Lines matching "<comment> ~ <code>" are copied in as code.
+    """
+    exec_lines = []
+    in_between = []
+    indent = ''
+
+    def flush_between():
+        if in_between:
+            if precompile:
+                block = compile_block(in_between, var_regex)
+            else:
+                block = LEGACY_BLOCK.format(escape_block(in_between))
+            exec_lines.append(indent + '_lines.append({})'.format(block))
+            in_between.clear()
+
+    for line in content.split('\n'):
+        if re.match(r'\s*' + comment + r'\s*~', line):
+            code_line = line.split('~', 1)[-1].strip()
+            flush_between()
+            if code_line == '#':
+                if not indent:
+                    raise ValueError('Too many unindents')
+                indent = indent[1:]
+            else:
+                exec_lines.append(indent + code_line)
+                if code_line.endswith(':'):
+                    indent += ' '
+        else:
+            in_between.append(line)
+    flush_between()
+    if indent:
+        raise ValueError('{} indents remaining at end of file'.format(len(indent)))
+    return '\n'.join(exec_lines)
+
+
+STREAM_PIECE = 1 << 16  # Literal characters read from a streamed template at once
+
+
+def crosses_lines(var_regex: str) -> bool:
+    """Whether a {{...}} regex could match across a line break (so literal runs can't be split)"""
+    return '\n' in var_regex or bool(re.search(r'\\[nrsSWD]|\[\^|\(\?[a-zA-Z]*s', var_regex))
+
+
+def translate_stream(f, comment: str, var_regex: str, piece_size: int = STREAM_PIECE):
+    """
+    Like translate(), but reads the template from a text file and leaves
+    its literal lines there. Each run of them becomes eval(_block(i)),
+    which reads the run back while rendering. Long runs are split into
+    pieces that are appended to the previous block with _lines.extend_last().
+    Returns the source and the (file position, line count) of each block.
+    """
+    directive = re.compile(r'\s*' + comment + r'\s*~')
+    splittable = not crosses_lines(var_regex)
+    exec_lines, blocks = [], []
+    indent = ''
+    start, count, size, continued, escaped = 0, 0, 0, False, False
+
+    def flush_between():
+        nonlocal count, size
+        if count:
+            if continued:  # On the same line so it ends up in the same statement as the first piece
+                exec_lines[-1] += '; _lines.extend_last(eval(_block({})))'.format(len(blocks))
+            else:
+                exec_lines.append(indent + '_lines.append(eval(_block({})))'.format(len(blocks)))
+            blocks.append((start, count))
+            count = size = 0
+
+    ended = True  # Like str.split('\n'), a final line break is followed by an empty line
+    while True:
+        position = f.tell()
+        raw = f.readline()
+        if not raw and not ended:
+            break
+        ended = raw.endswith('\n')
+        line = raw[:-1] if ended else raw
+        if directive.match(line):
+            code_line = line.split('~', 1)[-1].strip()
+            flush_between()
+            continued = False
+            if code_line == '#':
+                if not indent:
+                    raise ValueError('Too many unindents')
+                indent = indent[1:]
+            else:
+                exec_lines.append(indent + code_line)
+                if code_line.endswith(':'):
+                    indent += ' '
+        else:
+            if count and size >= piece_size and splittable and not escaped:
+                flush_between()
+                continued = True
+            if not count:
+                start = position
+            count += 1
+            size += len(line)
+            escaped = (len(line) - len(line.rstrip('\\'))) % 2 == 1  # Joins the next line
+        if not raw:
+            break
+    flush_between()
+    if indent:
+        raise ValueError('{} indents remaining at end of file'.format(len(indent)))
+    return '\n'.join(exec_lines), blocks
+
+
+def compile_stream(f, comment: str, var_regex: str):
+    """Compiles a streamed template, checking every block so errors are found before rendering"""
+    source, blocks = translate_stream(f, comment, var_regex)
+    reader = BlockReader(f, blocks, var_regex)
+    for index in range(len(blocks)):
+        reader(index)
+    return compile(source, '<string>', 'exec'), tuple(blocks)
+
+
+class BlockReader:
+    """
+    Reads the literal blocks of a streamed template back from its file
+    and compiles each into the same expression translate() would inline.
+    Small blocks stay compiled (up to a total size) for when they are
+    rendered again in a loop.
+    """
+    KEEP_SIZE = 1 << 12
+    KEEP_TOTAL = 1 << 22
+
+    def __init__(self, f, blocks, var_regex: str):
+        self.f = f
+        self.blocks = blocks
+        self.var_regex = var_regex
+        self.compiled = {}
+        self.kept = 0
+
+    def __call__(self, index):
+        if index in self.compiled:
+            return self.compiled[index]
+        position, count = self.blocks[index]
+        self.f.seek(position)
+        lines = [self.f.readline() for _ in range(count)]
+        lines = [i[:-1] if i.endswith('\n') else i for i in lines]
+        try:
+            code = compile(compile_block(lines, self.var_regex), '<string>', 'eval')
+        except SyntaxError:
+            code = compile(LEGACY_BLOCK.format(escape_block(lines)), '<string>', 'eval')
+        size = sum(map(len, lines))
+        if size < self.KEEP_SIZE and self.kept + size < self.KEEP_TOTAL:
+            self.compiled[index] = code
+            self.kept += size
+        return code
+
+
+class StrippedOutput:
+    """
+    Takes the place of _lines for a streamed template. Writes what
+    '\n'.join(blocks).strip() + '\n' would be as blocks are appended,
+    holding back only trailing whitespace.
+    """
+    HEAD_SIZE = 1 << 16
+
+    def __init__(self, f):
+        self.f = f
+        self.blocks = 0
+        self.started = False
+        self.pending = ''
+        self.head = ''  # Start of the output, to tell if later templates may append to it
+
+    def append(self, text):
+        if self.blocks:
+            self._write('\n')
+        self.blocks += 1
+        self._write(text)
+
+    def extend_last(self, text):
+        self._write('\n')
+        self._write(text)
+
+    def _write(self, text):
+        if not self.started:
+            text = text.lstrip()
+            if not text:
+                return
+            self.started = True
+        body = text.rstrip()
+        if not body:
+            self.pending += text
+            return
+        if len(self.head) < self.HEAD_SIZE:
+            self.head += (self.pending + body)[:self.HEAD_SIZE - len(self.head)]
+        self.f.write(self.pending)
+        self.f.write(body)
+        self.pending = text[len(body):]
+
+    def close(self) -> bool:
+        """Ends the output, returning False if the template rendered nothing"""
+        if not self.started and self.blocks <= 1:
+            return False
+        self.f.write('\n')
+        return True
+
+    def may_append(self) -> Optional[bool]:
+        """Like may_append() on the output, or None if the head alone can't tell"""
+        if may_append(self.head):
+            return True
+        first_break = self.head.find('\n')
+        if len(self.head) >= self.HEAD_SIZE and (first_break < 0 or '+++'.startswith(self.head[first_break:].lstrip())):
+            return None
+        return False
+
+
+def compile_template(content: str, comment: str, var_regex: str):
+    """Compiles a template, retrying with the original engine if the inlined form is rejected"""
+    try:
+        return compile(translate(content, comment, var_regex), '<string>', 'exec')
+    except SyntaxError:
+        return compile(translate(content, comment, var_regex, precompile=False), '<string>', 'exec')
+
+
+def template_globals() -> dict:
+    return {'_str': str, '_substitute': substitute}
+
+
+def classify_file(f, comment: str, var_regex: str, block_size: int = 1 << 16) -> str:
+    """
+    Returns 'binary' for files that are not text, 'static' for text that
+    renders to exactly its own bytes and 'template' for everything else.
+    Reads the binary file f in blocks of whole lines, so only the longest
+    line is ever held in memory.
+    """
+    decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))()
+    patterns = [re.compile(var_regex), re.compile(r'^\s*' + comment + r'\s*~', re.MULTILINE)]
+    kind, head, carry, tail, blocks = 'static', '', '', '', 0
+    try:
+        while True:
+            data = f.read(block_size)
+            text = decoder.decode(data, final=not data)
+            if kind != 'static':
+                if not data:
+                    return kind
+                continue  # Only checking that the rest decodes
+            text, carry = carry + text, ''
+            if data:
+                cut = text.rfind('\n') + 1  # Matches within a line are never split between blocks
+                text, carry = text[:cut], text[cut:]
+            if head is not None:
+                head += text
+                if not data or re.search(r'\n\s*\S', head):  # Enough to tell if it starts with "+++"
+                    if head[:1].isspace() or may_append(head):
+                        kind = 'template'
+                    head = None
+            if text:
+                blocks += 1
+                if (
+                    # Newline translation, escapes and null bytes all change the output
+                    any(c in text for c in '\r\\\0') or
+                    any(pattern.search(text) for pattern in patterns)
+                ):
+                    kind = 'template'
+                tail = (tail + text)[-2:]
+            if not data:
+                break
+    except UnicodeDecodeError:
+        return 'binary'
+    if kind != 'static' or len(tail) < 2 or tail[1] != '\n' or tail[0].isspace():
+        return 'template'  # Empty or surrounded by whitespace
+    if blocks > 1 and crosses_lines(var_regex):
+        return 'template'  # A variable could span two blocks
+    return kind
+
+
+DYNAMIC_NAMES = {'eval', 'exec', 'vars', 'globals', 'config', 'config_as', '_re'}
+INTERNAL_NAMES = {'_str', '_substitute', '_lines', '_config_val', '_block', 'locals'}
+
+
+def referenced_names(code) -> Optional[Set[str]]:
+    """
+    Names a compiled template can read, or None if it can look up variables
+    dynamically (legacy blocks, eval or a regex switched mid-render).
+    """
+    names = set(code.co_names) | set(code.co_freevars)
+    for const in code.co_consts:
+        if hasattr(const, 'co_names'):
+            inner = referenced_names(const)
+            if inner is None:
+                return None
+            names |= inner
+    if names & DYNAMIC_NAMES:
+        return None
+    return names - INTERNAL_NAMES
@@ -0,0 +1,116 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Callable, List, Optional
+
+
+class Span:
+    """Wall time and output size of one step of a generation"""
+    __slots__ = ('category', 'name', 'path', 'start', 'duration', 'bytes', 'pid', 'tid')
+
+    def __init__(self, category: str, name: str, path: Optional[str] = None):
+        self.category = category
+        self.name = name
+        self.path = path
+        self.start = perf_counter()
+        self.duration = 0.0
+        self.bytes = 0
+        self.pid = os.getpid()
+        self.tid = threading.get_ident()
+
+    def __getstate__(self):
+        return {i: getattr(self, i) for i in self.__slots__}
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    def as_dict(self):
+        return self.__getstate__()
+
+
+class _Disabled:
+    bytes = 0
+
+
+class Recorder:
+    """
+    Collects spans while enabled and passes each finished span to the
+    listeners, so wrappers can forward them to their own metrics.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans: List[Span] = []
+        self.listeners: List[Callable[[Span], None]] = []
+
+    def add_listener(self, listener: Callable[[Span], None]):
+        self.listeners.append(listener)
+        self.enabled = True
+
+    @contextmanager
+    def span(self, category, name, path=None):
+        if not self.enabled:
+            yield _Disabled()
+            return
+        span = Span(category, name, path)
+        try:
+            yield span
+        finally:
+            span.duration = perf_counter() - span.start
+            self.add([span])
+
+    def add(self, spans: List[Span]):
+        self.spans.extend(spans)
+        for span in spans:
+            for listener in self.listeners:
+                listener(span)
+
+    @contextmanager
+    def capture(self):
+        """Collects spans into a separate list without notifying listeners (for worker processes)"""
+        spans, listeners = self.spans, self.listeners
+        self.spans, self.listeners = [], []
+        try:
+            yield self.spans
+        finally:
+            self.spans, self.listeners = spans, listeners
+
+    def summary(self, top=5) -> str:
+        """Table of total time and bytes per category along with the slowest spans"""
+        totals = {}
+        for span in self.spans:
+            count, duration, size = totals.get(span.category, (0, 0.0, 0))
+            totals[span.category] = count + 1, duration + span.duration, size + span.bytes
+        lines = ['{:<14} {:>6} {:>11} {:>12}'.format('phase', 'count', 'time', 'bytes')]
+        for category, (count, duration, size) in sorted(totals.items(), key=lambda x: -x[1][1]):
+            lines.append('{:<14} {:>6} {:>9.1f}ms {:>12}'.format(category, count, duration * 1000, size))
+        slowest = sorted(self.spans, key=lambda x: -x.duration)[:top]
+        if slowest:
+            lines.append('')
+            lines.append('Slowest:')
+            for span in slowest:
+                lines.append('{:>9.1f}ms  {:<14} {}'.format(span.duration * 1000, span.category, span.path or span.name))
+        return '\n'.join(lines)
+
+    def trace_events(self) -> List[dict]:
+        """Spans as Chrome trace events (viewable in Perfetto or chrome://tracing)"""
+        origin = min((i.start for i in self.spans), default=0.0)
+        return [
+            dict(
+                name=span.name, cat=span.category, ph='X', pid=span.pid, tid=span.tid,
+                ts=(span.start - origin) * 1e6, dur=span.duration * 1e6,
+                args=dict(path=span.path, bytes=span.bytes)
+            )
+            for span in self.spans
+        ]
+
+    def write_trace(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(dict(traceEvents=self.trace_events(), displayTimeUnit='ms'), f)
+
+
+recorder = Recorder()
+
@@ -0,0 +1,172 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from os.path import join, exists
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from proyo.manifest import Manifest, Unchanged, data_hash, file_hash
+from proyo.output import DirectoryWriter, RenderedFile
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, length of the name that follows
+
+
+def _ignored(path) -> bool:
+    name = os.path.basename(path)
+    return '__pycache__' in path or name.endswith(('.pyc', '.swp', '.swx', '~')) or name.startswith('.#')
+
+
+class InotifyWatcher:
+    """Waits for changes below folders with Linux inotify (through ctypes)"""
+
+    def __init__(self, folders: List[str]):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.folders: Dict[int, str] = {}
+        for folder in folders:
+            self._add_tree(folder)
+
+    def _add_tree(self, top):
+        for folder, dirs, names in os.walk(top):
+            dirs[:] = [i for i in dirs if i != '__pycache__']
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+            if wd >= 0:
+                self.folders[wd] = folder
+
+    def _read(self) -> Set[str]:
+        data = os.read(self.fd, 1 << 16)
+        changed, pos = set(), 0
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, pos)
+            name = data[pos + EVENT.size:pos + EVENT.size + length].rstrip(b'\0')
+            pos += EVENT.size + length
+            if wd not in self.folders:
+                continue
+            path = join(self.folders[wd], os.fsdecode(name))
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(path)
+            changed.add(path)
+        return changed
+
+    def wait(self, settle=0.1) -> Set[str]:
+        """Blocks until something changes, then collects changes until none came for settle seconds"""
+        changed = set()
+        timeout = None
+        while True:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if not ready:
+                if changed:
+                    return changed
+                continue
+            changed |= {i for i in self._read() if not _ignored(i)}
+            timeout = settle if changed else None
+
+
+class PollingWatcher:
+    """Waits for changes below folders by comparing their modification times"""
+
+    def __init__(self, folders: List[str], interval=0.5):
+        self.folders = folders
+        self.interval = interval
+        self.state = self._scan()
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        state = {}
+        for top in self.folders:
+            for folder, dirs, names in os.walk(top):
+                dirs[:] = [i for i in dirs if i != '__pycache__']
+                for name in names:
+                    path = join(folder, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    state[path] = (stat.st_mtime_ns, stat.st_size)
+        return state
+
+    def wait(self) -> Set[str]:
+        while True:
+            time.sleep(self.interval)
+            state = self._scan()
+            changed = {i for i in set(state) | set(self.state) if state.get(i) != self.state.get(i)}
+            self.state = state
+            changed = {i for i in changed if not _ignored(i)}
+            if changed:
+                return changed
+
+
+def make_watcher(folders: List[str]):
+    """Inotify watcher where available, polling otherwise"""
+    folders = [i for i in folders if exists(i)]
+    try:
+        return InotifyWatcher(folders)
+    except (OSError, AttributeError):  # Not Linux or out of watches
+        return PollingWatcher(folders)
+
+
+def watch_changes(folders: List[str]) -> Iterator[Set[str]]:
+    watcher = make_watcher(folders)
+    while True:
+        yield watcher.wait()
+
+
+class Preview:
+    """
+    Keeps a preview folder in sync with a template tree as it is edited.
+    Renders are recorded in a manifest kept in memory, so a template is
+    only rendered again if its source or the value of a variable it reads
+    (including the exports of scripts) changed, and only files whose
+    content changed are written.
+    """
+
+    def __init__(self, folder: str, ignore=()):
+        self.folder = folder
+        self.ignore = ignore
+        self.manifest: Optional[Manifest] = None
+
+    def next_manifest(self) -> Manifest:
+        previous = self.manifest
+        data = previous and dict(files=previous.files, renders=previous.renders)
+        return Manifest(data, self.ignore)
+
+    def write(self, manifest: Manifest, files: dict) -> Tuple[int, List[str], List[str]]:
+        """
+        Writes the changed files and removes the ones no longer generated,
+        returning how many templates were rendered and the paths written and removed
+        """
+        writer = DirectoryWriter(self.folder)
+        rendered, written = 0, []
+        for relative, data in files.items():
+            if data is None:
+                continue
+            if isinstance(data, Unchanged):
+                manifest.files[relative] = dict(hash=data.hash)
+                continue
+            rendered += isinstance(data, (str, RenderedFile))
+            new_hash = data_hash(data)
+            manifest.files[relative] = dict(hash=new_hash)
+            if file_hash(join(self.folder, relative)) != new_hash:
+                writer.write(relative, data)
+                written.append(relative)
+            elif isinstance(data, RenderedFile):
+                data.discard()
+        removed = manifest.removed()
+        for relative in removed:
+            if exists(join(self.folder, relative)):
+                os.remove(join(self.folder, relative))
+        manifest.finish()
+        self.manifest = manifest
+        return rendered, sorted(written), removed
@@ -31,7 +31,6 @@ setup(
     ],
     keywords="notify server",
     packages=["proyo"],
-    install_requires=["setuptools"],
     entry_points={
         "console_scripts": [
             "proyo=proyo.__main__:main",